@@ -9,10 +9,18 @@
 #   Issues raised:
 #   Date Valid should really be the zero time for the file.
 
-import sys, csv, string
+import sys, csv, string, itertools, operator
 import time, StringIO
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 import unittest
 import os,os.path
+import multiprocessing, mmap, re
+import json, struct, hashlib, shutil
 
 # ======================================================================
 # Provides the following exceptions
@@ -61,10 +69,11 @@ def checkType(values,func):
             for v in values:
                 if not isinstance(v,func):
                     try:
-                        i=int(v)
                         f=float(v)
-                        if float(i)!=f and func == int: 
-                            raise ValueError('%s in %s is not %s'%(v,values,func))
+                        if func == int:
+                            i=int(v)
+                            if float(i)!=f:
+                                raise ValueError('%s in %s is not %s'%(v,values,func))
                     except:
                         raise ValueError('%s in %s is not %s'%(v,values,func))
     else: raise ValueError (
@@ -127,6 +136,52 @@ def checkDataType(values):
         raise BADCtfMetadataNonstandard(
 			"Type not right must be int, float or char. not %s" % v)
 
+def _format_value(v):
+    # a data value as text: floats in full, anything else with str
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+def _cdl_string(v):
+    # a quoted CDL string
+    return '"%s"' % str(v).replace('\\', '\\\\').replace('"', '\\"')
+
+# ======================================================================
+# Typecodes used to store int and float columns (see BADCtfVariable);
+# char columns are stored as offsets into a byte buffer.
+
+ARRAY_TYPECODES = {'int': 'l', 'float': 'd'}
+
+# numpy dtypes used for each column type by the batch reader
+NUMPY_TYPES = {'int': 'i8', 'float': 'f8', 'char': 'S'}
+
+# number of rows tokenised at a time when reading a data section
+BLOCKSIZE = 10000
+
+# number of values on each line of CDL data
+CDL_PERLINE = 10
+
+# the line that ends a data section
+END_DATA = re.compile(r'^end data,*\r?$', re.I | re.M)
+NON_BLANK = re.compile(r'\S')
+
+# comparisons for BADCtfRowFilter tests
+OPERATORS = {'<': operator.lt, '<=': operator.le, '==': operator.eq,
+             '!=': operator.ne, '>=': operator.ge, '>': operator.gt}
+
+# patterns matching the cells, one to a line, that int() or float() would
+# not read
+BAD_CELLS = {
+    'int': re.compile(r'^(?![ \t]*[+-]?\d+[ \t]*$).*$', re.M),
+    'float': re.compile(r'^(?![ \t]*[+-]?(?:(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?'
+                        r'|nan|inf|infinity)[ \t]*$).*$', re.M | re.I)}
+
+# the most bytes read by one BADCtfFollow poll
+FOLLOW_READ = 1 << 24
+
+# first bytes of a BADCtfCache file
+CACHE_MAGIC = 'BADCTFC1'
+
 # ======================================================================
 # The BADCtf class is the main class for manipulating data.
 #
@@ -206,13 +261,20 @@ class BADCtf:
               "cell_method":            (1,1,1,4,0,0,checkCellMethod, 
 					"The cell method used in preparing the data")}
 
-    def __init__(self, mode='w',filename='',):
+    # a BADCtfStats to record the time spent in each phase, if wanted
+    stats = None
+
+    def __init__(self, mode='w',filename='', workers=None, offset=0,
+                 rows=None, mapped=False, cache=False, columns=None,
+                 where=None, between=None, monotonic=False, stats=None):
         ''' Instantiate a BADCText file, default mode is to create
         a new instance ready for writing. (In which case don't provide
         a filename  - only provide a filename if reading an existing
-        instance. '''
+        instance, or adding rows to one with mode 'a'. The other
+        arguments choose how and what is read; see _parse, BADCtfCache
+        and BADCtfStats. '''
         
-        if mode not in ['r','w']:
+        if mode not in ['r','w','a']:
             raise BADCtfError('Cannot instantiate with mode %s'%mode)
         if mode=='w' and filename<>'':
             raise BADCtfError('Do not instantiate in write mode with a filename')
@@ -220,10 +282,30 @@ class BADCtf:
         self.mode=mode
         self._data = BADCtfData()
         self._metadata = BADCtfMetadata()
+        self._decoded = {}
+        if stats is not None:
+            self.stats = stats
         
         if self.mode == 'r':
-            self._parse(filename)
+            cache = (cache and rows is None and not mapped and
+                     columns is None and where is None and between is None)
+            if stats is not None: start = time.time()
+            if cache and BADCtfCache.load(self, filename, offset):
+                if stats is not None:
+                    stats.add('cache', time.time()-start, len(self))
+                return
+            self._parse(filename, workers, offset, rows, mapped, columns,
+                        where, between, monotonic)
             self._check_valid()
+            if cache:
+                # the file has been read, so carry on without a cache if
+                # one cannot be written (e.g. a read only directory)
+                try:
+                    BADCtfCache.save(self, filename, offset)
+                except (IOError, OSError):
+                    pass
+        elif self.mode == 'a':
+            self._open_append(filename, offset)
         else:
             self.version='1'
             self.add_metadata('Conventions',('BADC-CSV', '1'),'G')
@@ -234,87 +316,359 @@ class BADCtf:
     def __ne__(self,other):
         return not self==other
 
-    def _parse(self,filename):
-        ''' Parse file filename to populate this instance. ''' 
-        self.fh=open(filename,'r')
-        reader = csv.reader(self.fh)
-        section = 1
-        for row in reader:
-          try:
-            # section 1 is the metadata section 
-            if section == 1:
-                while row[-1] == '': row=row[:-1] # remove blank cells
-                if len(row) == 0: continue        # ignore blank lines
-                elif len(row) == 1:
-                    if row[0].lower() == 'data':
-                        section = 2
-                        continue
-                else:
-                    label, ref, values = row[0], row[1], row[2:]
-                    values = tuple(values)
-                    self.add_metadata(label,values,ref) 
-
-            # section 2 the column names
-            elif section == 2:
-                while row[-1] == '': row=row[:-1] # remove blank cells
-                for colname in row:
-                    self.add_variable(colname)
-                section = 3
-
-            # section 3 is the data section 
-            elif section == 3:
-                while row[-1] == '': row=row[:-1] # remove blank cells
-                if len(row) == 0: continue        # ignore blank lines
-                elif len(row) == 1: 
-                    if row[0].lower() == 'end data':
-                        return
-                else:
-                    # data row
-                    self.add_datarecord(row) 
-
-          except BADCtfError:
-              print row
-              raise 
+    def _open_append(self, filename, offset):
+        ''' Mode 'a': open filename to add rows to the end of the record
+        at offset, which must be the last in the file. Only the metadata
+        and column names are read and checked; the data rows are not
+        read, so len() is 0. Rows added with append_rows or add_datarecord
+        are written over the end data line, which is written again after
+        them, so the file is complete between calls. Call close when
+        done. '''
+        self._fh = open(filename, 'r+b')
+        try:
+            self._fh.seek(offset)
+            reader = BADCtfReader(self._fh, offset)
+            if not reader.read_header(self) or self.nvar() == 0:
+                raise BADCtfParseError('No column names in %s' % filename)
+            self._check_valid()
+            index = BADCtfIndex.load(filename)
+            if index and [r for r in index.records if r['start'] > offset]:
+                raise BADCtfError('Can only append to the last record')
+            # without an index, look for anything after this record's end
+            # data line
+            mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                end = _find_end_data(mm, reader.offset)
+                if end < len(mm) and NON_BLANK.search(
+                        mm, END_DATA.match(mm, end).end()):
+                    raise BADCtfError('Can only append to the last record')
+            finally:
+                mm.close()
+            self._end, newline = _find_trailer(self._fh, reader.offset)
+        except:
+            self._fh.close()
+            raise
+        self._newline = newline
+
+    def append_rows(self, rows):
+        ''' Append rows, each a sequence with a value for every column, to
+        a file opened in mode 'a'. No rows are written if any is the wrong
+        length. '''
+        if self.mode != 'a':
+            raise BADCtfError('Can only append rows in mode a')
+        rows = list(rows)
+        nvar = self.nvar()
+        for row in rows:
+            if len(row) != nvar:
+                raise BADCtfError("Wrong length of data: %s" % (row,))
+        if self.stats is not None: start = time.time()
+        # the rows and the end data line go in one write, so that a
+        # reader following the file does not see part of them
+        text = StringIO.StringIO()
+        csvwriter = csv.writer(text, lineterminator=self._newline)
+        csvwriter.writerows(rows)
+        end = self._end + text.tell()
+        csvwriter.writerow(('End Data',))
+        self._fh.seek(self._end)
+        self._fh.write(text.getvalue())
+        self._fh.truncate()
+        self._fh.flush()
+        self._end = end
+        if self.stats is not None:
+            self.stats.add('append', time.time()-start, len(rows))
+
+    def close(self):
+        ''' Close the file of an instance opened in mode 'a' '''
+        if self.mode == 'a':
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _parse(self,filename,workers=None,offset=0,rows=None,mapped=False,
+               columns=None,where=None,between=None,monotonic=False):
+        ''' Parse file filename to populate this instance. offset is the
+        byte offset of the record to read in a file that holds several
+        (see records). rows reads a window of the data rows (see
+        _parse_rows), mapped=True leaves them in the mapped file (see
+        _map_rows) and workers > 1 parses them on a process pool (see
+        _parse_ranges). columns selects columns (see _select), and where,
+        between and monotonic select rows (see _row_filter). '''
+        fh=open(filename,'rb')
+        try:
+            fh.seek(offset)
+            reader = BADCtfReader(fh, offset)
+            if not reader.read_header(self):
+                return
+            if self.nvar() == 0:
+                if columns is not None or where or between:
+                    raise BADCtfError('Cannot select columns without names')
+                # no column names, columns are made from the first row
+                for row in reader.rows():
+                    self.add_datarecord(row)
+                return
+            ncols = self.nvar()
+            if self.stats is not None: start = time.time()
+            try:
+                test = self._row_filter(where, between, monotonic)
+                keep = self._select(columns)
+                if rows is not None:
+                    self._parse_rows(filename, reader, offset, rows, ncols,
+                                     keep, test)
+                    return
+                if mapped:
+                    if test:
+                        raise BADCtfError(
+                            'Cannot filter the rows of a mapped file')
+                    self._map_rows(fh, reader, keep)
+                    return
+                if workers > 1:
+                    self._parse_ranges(filename, fh, reader.offset, workers,
+                                       ncols, keep, test)
+                    return
+                for block in reader.blocks(BLOCKSIZE, ncols, keep, test):
+                    self._data.add_columns(block)
+            finally:
+                if self.stats is not None:
+                    self.stats.add('data', time.time()-start, len(self))
+        finally:
+            fh.close()
+
+    def _select(self, columns):
+        ''' Keep only the columns named in columns, in the order given.
+        The other cells are dropped as rows are split, and the metadata
+        records of the other columns are kept but not checked. Returns the
+        positions of the kept cells in a row, or None to keep them all. '''
+        if columns is None:
+            return None
+        colnames = self.colnames()
+        for colname in columns:
+            if colname not in colnames:
+                raise BADCtfError('No column %s' % colname)
+        keep = [colnames.index(colname) for colname in columns]
+        data = BADCtfData()
+        for colname, j in zip(columns, keep):
+            data.add_variable(colname, (), self._data.variables[j].vtype)
+        self._data = data
+        return keep
+
+    def _row_filter(self, where, between, monotonic):
+        ''' Return a BADCtfRowFilter for where, a list of (column, op,
+        value) tests with op one of OPERATORS, and between, a (low, high)
+        range for the coordinate variable (low <= value < high, either may
+        be None), or None if there are no tests. If the coordinate variable
+        increases down the file, monotonic=True stops reading at the first
+        row past the range. '''
+        if not where and between is None:
+            return None
+        colnames = self.colnames()
+        tests = []
+        for colname, op, value in where or ():
+            if colname not in colnames:
+                raise BADCtfError('No column %s' % colname)
+            if op not in OPERATORS:
+                raise BADCtfError('Unknown comparison %s' % op)
+            vtype, value = self._filter_value(colname, value)
+            tests.append((colnames.index(colname), vtype, op, value))
+        stop = None
+        if between is not None:
+            for j, colname in enumerate(colnames):
+                if self['coordinate_variable', colname]:
+                    break
+            else:
+                raise BADCtfError('No coordinate variable to select rows by')
+            low, high = between
+            if low is not None:
+                vtype, low = self._filter_value(colname, low)
+                tests.append((j, vtype, '>=', low))
+            if high is not None:
+                vtype, high = self._filter_value(colname, high)
+                tests.append((j, vtype, '<', high))
+                if monotonic:
+                    stop = (j, vtype, high)
+        return BADCtfRowFilter(tests, stop)
+
+    def _filter_value(self, colname, value):
+        ''' The type to compare the cells of colname as, and value to
+        compare them with. Cells of int and float columns, and of columns
+        with no type when value is a number, are compared as numbers with
+        value as a float. '''
+        vtype = self._coltype(colname)
+        if vtype not in ARRAY_TYPECODES:
+            if vtype is not None or not isinstance(value, (int, long, float)):
+                return vtype, value
+            vtype = 'float'
+        try:
+            return vtype, float(value)
+        except (TypeError, ValueError):
+            raise BADCtfError('Cannot compare column %s with %r'
+                              % (colname, value))
+
+    def _parse_rows(self, filename, reader, offset, rows, ncols, keep=None,
+                    test=None):
+        ''' Parse only the data rows in rows, a slice or (start, stop)
+        pair, seeking with a current BADCtfIndex for the file if there is
+        one. '''
+        if type(rows) == slice:
+            if rows.step not in (None, 1):
+                raise BADCtfError('Cannot read rows with a step')
+            start, stop = rows.start or 0, rows.stop
+        else:
+            start, stop = rows
+        if start < 0 or (stop is not None and stop < 0):
+            raise BADCtfError('Cannot read rows counted from the end')
+        index = BADCtfIndex.load(filename)
+        record = index and index.record(offset)
+        if record and record['offsets']:
+            k = min(start // index.every, len(record['offsets'])-1)
+            reader.fh.seek(record['offsets'][k])
+            reader.offset = record['offsets'][k]
+            skip = start - k*index.every
+        else:
+            skip = start
+        for _ in itertools.islice(reader.row_offsets(), skip):
+            pass
+        while not reader.done and (stop is None or start < stop):
+            n = BLOCKSIZE
+            if stop is not None: n = min(n, stop-start)
+            for block in reader.blocks(n, ncols, keep, test):
+                # a block is n rows, or the last rows, before any are
+                # filtered out
+                self._data.add_columns(block)
+                start += n
+                break
+
+    def _map_rows(self, fh, reader, keep=None):
+        ''' Map the file into memory and only find where the data rows
+        are; cells are decoded when they are accessed (see
+        BADCtfMappedData). '''
+        starts, ends = array.array('L'), array.array('L')
+        for offset in reader.row_offsets():
+            starts.append(offset)
+            ends.append(reader.offset)
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        vtypes = [v.vtype for v in self._data.variables]
+        self._data = BADCtfMappedData(mm, self._data.colnames, vtypes,
+                                      starts, ends, keep)
+
+    def _parse_ranges(self, filename, fh, start, workers, ncols, keep=None,
+                      test=None):
+        ''' Parse the data section from start in workers byte ranges on
+        a process pool '''
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            end = _find_end_data(mm, start)
+            ranges = _split_ranges(mm, start, end, workers)
+        finally:
+            mm.close()
+        colnames = self.colnames()
+        vtypes = [v.vtype for v in self._data.variables]
+        jobs = [(filename, a, b, colnames, vtypes, ncols, keep, test)
+                for a, b in ranges]
+        pool = multiprocessing.Pool(workers)
+        try:
+            parts = pool.map(_parse_range, jobs)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        for data in parts:
+            self._data.extend(data)
+
+    @staticmethod
+    def read_many(filenames, workers=None):
+        ''' Read and validate many files on a pool of worker processes
+        (by default one per CPU). Yields (filename, badctf, error) for each
+        file as it finishes, so not in the order given. error is the
+        exception raised when a file could not be read, and badctf is then
+        None. '''
+        jobs = [(filename, {}) for filename in filenames]
+        if workers == 1:
+            for job in jobs:
+                yield _read_file(job)
+            return
+        pool = multiprocessing.Pool(workers)
+        try:
+            for result in pool.imap_unordered(_read_file, jobs):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @staticmethod
+    def records(filename):
+        ''' Return the data records in filename as a sequence of BADCtf
+        instances, each parsed when it is accessed (see BADCtfRecords) '''
+        return BADCtfRecords(filename)
+
+    @staticmethod
+    def open_stream(filename, offset=0, columns=None, where=None,
+                    between=None, monotonic=False):
+        ''' Open filename to read its data rows lazily (see BADCtfStream) '''
+        return BADCtfStream(filename, offset, columns, where, between,
+                            monotonic)
+
+    @staticmethod
+    def tail(filename, offset=0, columns=None, where=None, between=None):
+        ''' Open filename to read its data rows as they are added to it
+        (see BADCtfFollow) '''
+        return BADCtfFollow(filename, offset, columns, where, between)
 
     def _check_valid(self):
         ''' Check content of this instance is valid '''
-        for label in BADCtf.MDinfo:
-            applyg, applyc, mino, maxo, mandb, mandc, check, meaning = BADCtf.MDinfo[label]
-
-            # if label can't apply globally but is defined raise error 
-            if not applyg and self[label] != []:
-                raise BADCtfMetadataInvalid("Not allowed as global metadata parameter: %s, %s" %(label, self[label]))
-            # if label can't apply to column but is defined raise error 
-            if not applyc and self[label] == []:
-                for colname in self.colnames():
-                    if self[label,colname] != []: 
-                        raise BADCtfMetadataInvalid("Given metadata not allowed for a column: %s, %s, %s" %(label, colname, self[label,colname]))
-            # values have wong number of feilds 
-            for values in self[label]:
-                if len(values) > maxo:
-                    raise BADCtfMetadataInvalid("Max number of metadata fields (%s) exceeded for %s: %s" % (maxo, label, values))
-                if len(values) < mino:
-                    raise BADCtfMetadataInvalid("Min number of metadata fields (%s) not given for %s: %s" % (mino, label, values,))
-            for colname in self.colnames():
-              for values in self[label,colname]:
-                if len(values) > maxo:
-                    raise BADCtfMetadataInvalid("Max number of metadata fields (%s) exceeded for %s: %s" % (maxo, label, values,))
-                if len(values) < mino:
-                    raise BADCtfMetadataInvalid("Min number of metadata fields (%s) not given for %s: %s" % (mino, label, values,))
-
-            #see if values are OK
-            for values in self[label]:
-                try: 
-                    check(values)
-                except:
-                    raise BADCtfMetadataInvalid("Metadata field values invalid %s: %s  [%s]" % (label, values,sys.exc_value))    
-            for colname in self.colnames():
-                for values in self[label,colname]:
-                    check(values)
+        self.validate().raise_first()
 
     def _check_complete(self, level='basic'):
         ''' Check content of this instance is complete '''
-        self._check_valid()
+        self.validate(level).raise_first()
+
+    def validate(self, level=None, data=False):
+        ''' Check the metadata in one pass over the records, returning a
+        BADCtfReport of every problem found rather than raising on the
+        first. If level is given ('basic', or anything else for complete)
+        missing mandatory metadata is reported too. Records for columns
+        that are not in this instance are not checked. With data=True the
+        data cells are checked too (see check_data). '''
+        if self.stats is not None: start = time.time()
+        report = BADCtfReport()
+        colnames = self.colnames()
+        columns = set(colnames)
+        seen_global = set()   # labels with a global record
+        seen_column = {}      # label -> columns with a record
+
+        for label, values in self._metadata.globalRecords:
+            seen_global.add(label)
+            rule = BADCtf.MDinfo.get(label)
+            if rule is None: continue
+            if not rule[0]:
+                report.add(label, 'G', values, BADCtfMetadataInvalid(
+                    "Not allowed as global metadata parameter: %s, %s" %(label, values)))
+            self._check_record(report, label, 'G', values, rule)
+
+        for label, colname, values in self._metadata.varRecords:
+            if colname not in columns: continue
+            seen_column.setdefault(label, set()).add(colname)
+            rule = BADCtf.MDinfo.get(label)
+            if rule is None: continue
+            if not rule[1]:
+                report.add(label, colname, values, BADCtfMetadataInvalid(
+                    "Given metadata not allowed for a column: %s, %s, %s" %(label, colname, values)))
+            self._check_record(report, label, colname, values, rule)
+
+        if data:
+            self.check_data(report)
+
+        if level is None:
+            if self.stats is not None:
+                self.stats.add('validate', time.time()-start,
+                               len(self._metadata.globalRecords) +
+                               len(self._metadata.varRecords))
+            return report
+
         for label in BADCtf.MDinfo:
             applyg, applyc, mino, maxo, mandb, mandc, check, meaning = BADCtf.MDinfo[label]
 
@@ -322,37 +676,60 @@ class BADCtf:
             if level=='basic': mand = mandb
             else: mand = mandc
 
-            #if its not manditory skip
-            if not mand:
+            #if its not manditory or given globally skip
+            if not mand or label in seen_global:
                 continue
 
             # if applies globally then there should be a global record or
             # one at least one variable
             if applyg:
-              if self[label] != []:
-                  #found global value. next label
-                  continue
-              for colname in self.colnames():
-                  if self[label,colname] != []:
-                      break
-              else:
-                  raise BADCtfMetadataIncomplete("Basic global metadata not there: %s" % label)
-                  
+                if not seen_column.get(label):
+                    report.add(label, 'G', (), BADCtfMetadataIncomplete(
+                        "Basic global metadata not there: %s" % label))
+
             # if applies to column only then there should be a record for
             # each variable
             elif applyc and mand==2:
-              for colname in self.colnames():
-                  if self[label,colname] == []: 
-                      raise BADCtfMetadataIncomplete(
-                        'Basic column metadata not there: "%s" not there for %s' % (label, colname))
+                for colname in colnames:
+                    if colname not in seen_column.get(label, ()):
+                        report.add(label, colname, (), BADCtfMetadataIncomplete(
+                            'Basic column metadata not there: "%s" not there for %s' % (label, colname)))
 
         # for metadata where one needs to exist in a column, 
         # check that at least one exists
         for label in ['coordinate_variable',]:
-            r=self._metadata[(label,'*')]
-            if r==[]: raise BADCtfMetadataIncomplete(
-                    'At least one column needs to have %s information'%label)
-    
+            if self._metadata[(label,'*')]==[]:
+                report.add(label, '*', (), BADCtfMetadataIncomplete(
+                    'At least one column needs to have %s information'%label))
+        if self.stats is not None:
+            self.stats.add('validate', time.time()-start,
+                           len(self._metadata.globalRecords) +
+                           len(self._metadata.varRecords))
+        return report
+
+    def _check_record(self, report, label, ref, values, rule):
+        # check the number of values and the values of one record
+        applyg, applyc, mino, maxo, mandb, mandc, check, meaning = rule
+        if len(values) > maxo:
+            report.add(label, ref, values, BADCtfMetadataInvalid(
+                "Max number of metadata fields (%s) exceeded for %s: %s" % (maxo, label, values)))
+        elif len(values) < mino:
+            report.add(label, ref, values, BADCtfMetadataInvalid(
+                "Min number of metadata fields (%s) not given for %s: %s" % (mino, label, values)))
+        else:
+            try: 
+                if self.stats is None:
+                    check(values)
+                else:
+                    start = time.time()
+                    try:
+                        check(values)
+                    finally:
+                        self.stats.add('check:%s' % label, time.time()-start)
+            except:
+                report.add(label, ref, values, BADCtfMetadataInvalid(
+                    "Metadata field values invalid %s: %s  [%s]" % (label, values,sys.exc_value)))
+
     def coordinate_variables(self):
         ''' Check that the coordinate variable comes first, as required
         by NASA Ames, and return coordinate variables '''
@@ -388,13 +765,145 @@ class BADCtf:
         
     def add_variable(self,colname,data=()):
         # -- ref change
-        self._data.add_variable(colname, data)
+        # store the column in a typed buffer if its type is already known
+        self._data.add_variable(colname, data, self._coltype(colname))
+        self._decoded.clear()
+
+    def _coltype(self, colname):
+        # the declared type of a column, or None
+        vtype = self['type', colname]
+        if vtype: return vtype[-1][0]
+        return None
 
     def add_datarecord(self, datavalues):
+        if self.mode == 'a':
+            self.append_rows([datavalues])
+            return
         self._data.add_data_row(datavalues)
+        self._decoded.clear()
 
     def add_metadata(self, label, values, ref='G'):
         self._metadata.add_record(label, values, ref)
+        self._decoded.clear()
+
+    def decoded(self, i):
+        ''' Return column i (an index or a column name) as physical values,
+        in a numpy masked array. Raw values outside valid_min, valid_max or
+        valid_range are masked, then the values are multiplied by
+        scale_factor and add_offset is added, as in CF. A column record is
+        used in preference to a global one. Cells of int and float columns
+        that are not numbers are masked; columns of other types are
+        returned as strings, unmasked. The arrays are kept until data
+        or metadata is added. Needs numpy. '''
+        if numpy is None:
+            raise BADCtfError('numpy is needed to decode values')
+        colnames = self.colnames()
+        if not isinstance(i, int):
+            if i not in colnames:
+                raise BADCtfError('No column %s' % i)
+            i = colnames.index(i)
+        if i in self._decoded:
+            return self._decoded[i]
+        colname = colnames[i]
+
+        vtype = self._coltype(colname)
+        variable = getattr(self._data, 'variables', None)
+        if vtype not in ARRAY_TYPECODES:
+            values = numpy.ma.masked_array(
+                numpy.array(self._data.strings(i), dtype='S'))
+        else:
+            if variable and variable[i].vtype == vtype:
+                raw = numpy.frombuffer(variable[i].buffers(),
+                                       ARRAY_TYPECODES[vtype])
+                rows = []
+            else:
+                cells = self._data.strings(i)
+                rows = _bad_cells(cells, vtype)
+                raw = _cell_floats(cells, rows)
+            low, high = self._valid_bounds(colname)
+            mask = numpy.zeros(len(raw), bool)
+            mask[rows] = True
+            if low is not None: mask |= raw < low
+            if high is not None: mask |= raw > high
+            scale = self._number('scale_factor', colname)
+            offset = self._number('add_offset', colname)
+            values = raw.copy()
+            if scale is not None: values = values * scale
+            if offset is not None: values = values + offset
+            values = numpy.ma.masked_array(values, mask)
+        self._decoded[i] = values
+        return values
+
+    def _number(self, label, colname, k=0):
+        # value k of the last record for the column (or the last global
+        # record) as a float, or None
+        records = self[label, colname]
+        if records: return float(records[-1][k])
+
+    def _valid_bounds(self, colname):
+        # the (low, high) limits on the raw values of a column, either of
+        # which may be None
+        if self['valid_range', colname]:
+            return (self._number('valid_range', colname),
+                    self._number('valid_range', colname, 1))
+        return (self._number('valid_min', colname),
+                self._number('valid_max', colname))
+
+    def check_data(self, report=None):
+        ''' Check the cells of each int and float column against the
+        column's type and its valid_min, valid_max or valid_range, a block
+        of BLOCKSIZE rows at a time. A problem is added to report (a new
+        BADCtfReport by default, which is returned) for each column with
+        cells that do not conform, labelled type or valid_range, with the
+        row indices of the cells as its values and their number in its
+        message. Columns held in typed buffers already conform to their
+        type; the cells of other columns are matched with BAD_CELLS in one
+        go per block. Needs numpy. '''
+        if numpy is None:
+            raise BADCtfError('numpy is needed to check data')
+        if report is None:
+            report = BADCtfReport()
+        if self.stats is not None: start_time = time.time()
+        variables = getattr(self._data, 'variables', None)
+        n = len(self)
+        for j, colname in enumerate(self.colnames()):
+            vtype = self._coltype(colname)
+            if vtype not in ARRAY_TYPECODES:
+                continue
+            low, high = self._valid_bounds(colname)
+            typed = variables and variables[j].vtype == vtype
+            if typed:
+                column = numpy.frombuffer(variables[j].buffers(),
+                                          ARRAY_TYPECODES[vtype])
+            bad, outside = [], []
+            for start in range(0, n, BLOCKSIZE):
+                rows = []
+                if typed:
+                    raw = column[start:start+BLOCKSIZE]
+                else:
+                    cells = self._data.strings(j, start, start+BLOCKSIZE)
+                    rows = _bad_cells(cells, vtype)
+                    bad.extend([start+row for row in rows])
+                    if low is None and high is None:
+                        continue
+                    raw = _cell_floats(cells, rows)
+                if low is None and high is None:
+                    continue
+                out = numpy.zeros(len(raw), bool)
+                if low is not None: out |= raw < low
+                if high is not None: out |= raw > high
+                out[rows] = False
+                outside.extend((numpy.nonzero(out)[0] + start).tolist())
+            if bad:
+                report.add('type', colname, tuple(bad), BADCtfDataError(
+                    '%d cells of column %s are not %s' % (len(bad), colname, vtype)))
+            if outside:
+                report.add('valid_range', colname, tuple(outside), BADCtfDataError(
+                    '%d cells of column %s are outside %s to %s' % (
+                        len(outside), colname, low, high)))
+        if self.stats is not None:
+            self.stats.add('check_data', time.time()-start_time, n)
+        return report
         
     def __repr__(self):
         return self._csv()
@@ -408,45 +917,96 @@ class BADCtf:
         return s.getvalue() 
 
     def write(self,filename,fmt='csv'):
-        ''' Write output to filename in format (fmt) cvs or cdl '''
-        if fmt == 'csv':
-            s=self._csv()
-        elif fmt =='cdl':
-            s=self._cdl()
-        elif fmt=='na':
-            s=self._NASA_Ames()
-        else:  raise BADCTextError('Invalid format %s for writing'%sfmt)
-        f=file(filename,'w')
-        f.write(s)
+        ''' Write output to filename, or to a writable file object, in
+        format (fmt) csv, cdl or na '''
+        if fmt not in ('csv', 'cdl', 'na'):
+            raise BADCtfError('Invalid format %s for writing'%fmt)
+        if self.stats is not None: start = time.time()
+        if hasattr(filename, 'write'):
+            f=filename
+        else:
+            f=open(filename,'w')
+        try:
+            if fmt == 'csv':
+                BADCtfWriter(self, f).close()
+            elif fmt =='cdl':
+                for chunk in self._cdl_chunks():
+                    f.write(chunk)
+            else:
+                for chunk in self._NASA_Ames_chunks():
+                    f.write(chunk)
+        finally:
+            if f is not filename: f.close()
+            if self.stats is not None:
+                self.stats.add('write:%s' % fmt, time.time()-start, len(self))
+
+    def open_writer(self, target):
+        ''' Start writing this instance as csv to target, a filename or a
+        writable file object, returning a BADCtfWriter to add more rows '''
+        return BADCtfWriter(self, target)
 
     def _cdl(self):
         ''' Create a CDL file (possibly to make NetCDF) '''
-        s = "// This CDL file was generated from a BADC text file file\n"
-        s = s + "netcdf foo { \n"
-     
-        s = s + "dimensions:\n   point = %s;\n\n" % len(self) 
-     
-        s = s + "variables: \n"
+        return ''.join(self._cdl_chunks())
+
+    def _cdl_chunks(self):
+        ''' Yield the CDL text a piece at a time. Column values are
+        written BLOCKSIZE rows at a time, CDL_PERLINE to a line. '''
+        yield "// This CDL file was generated from a BADC text file file\n"
+        yield "netcdf foo { \n"
+
+        vartypes = []
         for colname in self.colnames():
-            varname = "%s" % colname
-            vartype = self['type', colname][0][0]
-            s = s + "    %s %s(point);\n" % (vartype, varname)
-        s = s + "\n"
+            vartype = self._coltype(colname)
+            if vartype is None:
+                raise BADCtfMetadataIncomplete('No type for column %s' % colname)
+            vartypes.append(vartype)
+
+        yield "dimensions:\n   point = %s;\n" % len(self) 
+        # char columns need a string length dimension too
+        n = len(self)
+        for j, colname in enumerate(self.colnames()):
+            if vartypes[j] == 'char':
+                strlen = 1
+                for start in range(0, n, BLOCKSIZE):
+                    values = self._data.strings(j, start, start+BLOCKSIZE)
+                    strlen = max(strlen, max(map(len, values)))
+                yield "   %s_strlen = %s;\n" % (colname, strlen)
+        yield "\n"
+     
+        yield "variables: \n"
+        for colname, vartype in zip(self.colnames(), vartypes):
+            if vartype == 'char':
+                yield "    char %s(point, %s_strlen);\n" % (colname, colname)
+            else:
+                yield "    %s %s(point);\n" % (vartype, colname)
+        yield "\n"
             
-        s = s + self._metadata.cdl()
-        s = s + "\n"
+        for chunk in self._metadata.cdl_chunks():
+            yield chunk
+        yield "\n"
         
-        s = s + "data:\n\n"
-        for i in range(self.nvar()):
-            varname = "%s" % self._data.colnames[i]
-            values = str(self[i])
-            s =s + "%s = %s;\n" % (varname, values)
-        s = s + "}\n"
-
-        return s
+        yield "data:\n\n"
+        for j, colname in enumerate(self.colnames()):
+            yield "%s = " % colname
+            for start in range(0, n, BLOCKSIZE):
+                values = self._data.strings(j, start, start+BLOCKSIZE)
+                if vartypes[j] == 'char':
+                    values = map(_cdl_string, values)
+                lines = [', '.join(values[k:k+CDL_PERLINE])
+                         for k in range(0, len(values), CDL_PERLINE)]
+                if start: yield ',\n    '
+                yield ',\n    '.join(lines)
+            yield " ;\n"
+        yield "}\n"
 
     def _NASA_Ames(self):
         # create a NASA-Ames file 1001 FFI
+        return ''.join(self._NASA_Ames_chunks())
+
+    def _NASA_Ames_chunks(self):
+        # yield a NASA-Ames file 1001 FFI, the header and then the data
+        # a block of rows at a time
         header = []
 
         # find creator and institute
@@ -499,7 +1059,6 @@ class BADCtf:
        
         # FIXME: #ASKSAM What should this look like? 
         coord=self._metadata[('long_name',cvars[0])]
-        print cvars,coord
         coords.append(coord[0])
         header.append('%s (%s)' %coord[0])
         
@@ -531,7 +1090,6 @@ class BADCtf:
         # variable names
         long_names=self._metadata[('long_name','*')]
         for name in long_names:
-            print name,coords
             if name not in coords:
                 long_name = "%s (%s)" % name
                 header.append(long_name)
@@ -551,16 +1109,978 @@ class BADCtf:
         header.append(s.getvalue()) 
     
         # make header
-        header="%s 1001\n%s" % (len(header)+nlines, string.join(header,'\n'))
+        yield "%s 1001\n%s" % (len(header)+nlines, string.join(header,'\n'))
 
-        # data space separated
-        data = ''
-        for i in range(len(self)):
-            data = data + ' '.join([str(i) for i in self._data.getrow(i)]) + '\n'
-    
-        return header+data
+        # data space separated, turned from columns into rows a block
+        # at a time
+        for rows in self._data.row_blocks(BLOCKSIZE, strings=True):
+            yield '\n'.join(map(' '.join, rows)) + '\n'
         
     
+def _count(mm, a, b, char='"'):
+    # count char in mm[a:b] without copying it all at once
+    n = 0
+    while a < b:
+        c = min(b, a + (1 << 24))
+        n += mm[a:c].count(char)
+        a = c
+    return n
+
+def _find_end_data(mm, start):
+    # offset of the end data line after start, skipping any inside quotes
+    quotes, pos = 0, start
+    while True:
+        match = END_DATA.search(mm, pos)
+        if match is None:
+            return len(mm)
+        quotes += _count(mm, pos, match.start())
+        if quotes % 2 == 0:
+            return match.start()
+        quotes += _count(mm, match.start(), match.end())
+        pos = match.end()
+
+def _split_ranges(mm, start, end, n):
+    # split [start, end) into up to n ranges at line starts that are not
+    # inside a quoted cell
+    bounds = [start]
+    quotes, pos = 0, start
+    for k in range(1, n):
+        target = start + (end - start) * k // n
+        if target > pos:
+            quotes += _count(mm, pos, target)
+            pos = target
+        while pos < end:
+            nl = mm.find('\n', pos, end)
+            if nl < 0:
+                pos = end
+                break
+            quotes += _count(mm, pos, nl)
+            pos = nl + 1
+            if quotes % 2 == 0:
+                break
+        if pos >= end:
+            break
+        bounds.append(pos)
+    bounds.append(end)
+    return zip(bounds[:-1], bounds[1:])
+
+def _find_trailer(fh, start):
+    # find where rows go in the record after offset start: over the last
+    # non-blank line if it is end data, or else at the end of the file.
+    # Only that line is read, back from the end. Returns the offset and
+    # the line ending.
+    fh.seek(0, 2)
+    size = pos = fh.tell()
+    chunks = []
+    blank = True
+    while pos > start:
+        n = min(1 << 16, pos - start)
+        pos -= n
+        fh.seek(pos)
+        chunk = fh.read(n)
+        chunks.append(chunk)
+        if blank:
+            chunk = chunk.rstrip()
+            blank = not chunk
+        if not blank and '\n' in chunk:
+            break
+    tail = ''.join(reversed(chunks))
+    text = tail.rstrip()
+    line = text.rfind('\n') + 1
+    if text and END_DATA.match(text, line):
+        if tail[len(text):len(text)+1] == '\r':
+            return pos + line, '\r\n'
+        return pos + line, '\n'
+    fh.seek(start)
+    line = fh.readline()
+    newline = line.endswith('\r\n') and '\r\n' or '\n'
+    if size > start:
+        fh.seek(size - 1)
+        if fh.read(1) != '\n':
+            fh.write(newline)
+            size += len(newline)
+    return size, newline
+
+def _bad_cells(cells, vtype):
+    # indices of the cells (strings) that are not vtype numbers, matched
+    # with BAD_CELLS in one go
+    if not cells:
+        return []
+    text = '\n'.join(cells)
+    if text.count('\n') != len(cells)-1:
+        text = '\n'.join([c.replace('\n', ' ') for c in cells])
+    # row of each bad cell from the newlines before it
+    rows = []
+    row, pos = 0, 0
+    for match in BAD_CELLS[vtype].finditer(text):
+        row += text.count('\n', pos, match.start())
+        pos = match.start()
+        rows.append(row)
+    return rows
+
+def _cell_floats(cells, rows):
+    # the cells as a float array, with 0 for the bad cells at rows
+    cells = numpy.array(cells, dtype='S')
+    cells[rows] = '0'
+    try:
+        return cells.astype(float)
+    except ValueError:
+        return numpy.array(map(float, cells))
+
+def _scan_records(filename):
+    # (start, data, end) offsets of each record in filename
+    records = []
+    fh = open(filename, 'rb')
+    try:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return records
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            reader = BADCtfReader(fh)
+            while True:
+                start = reader.offset
+                if not reader.read_header():
+                    break
+                end = _find_end_data(mm, reader.offset)
+                records.append((start, reader.offset, end))
+                # carry on after the end data line
+                nl = mm.find('\n', end)
+                if nl < 0:
+                    break
+                fh.seek(nl + 1)
+                reader.offset = nl + 1
+        finally:
+            mm.close()
+    finally:
+        fh.close()
+    return records
+
+def _file_hash(filename):
+    # sha1 hash of the contents of filename
+    sha1 = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        for data in iter(lambda: f.read(1 << 20), ''):
+            sha1.update(data)
+    finally:
+        f.close()
+    return sha1.hexdigest()
+
+def _latin1(value):
+    # undo the decoding of byte strings in a JSON cache header
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    elif isinstance(value, list):
+        return tuple([_latin1(v) for v in value])
+    return value
+
+def _parse_range(job):
+    # parse the data rows in one byte range for BADCtf._parse_ranges
+    filename, start, end, colnames, vtypes, ncols, keep, test = job
+    data = BADCtfData()
+    for colname, vtype in zip(colnames, vtypes):
+        data.add_variable(colname, (), vtype)
+    fh = open(filename, 'rb')
+    try:
+        fh.seek(start)
+        reader = BADCtfReader(fh, start, end)
+        for block in reader.blocks(BLOCKSIZE, ncols, keep, test):
+            data.add_columns(block)
+    finally:
+        fh.close()
+    return data
+
+def _read_file(job):
+    # read one file for BADCtf.read_many, returning any error
+    filename, options = job
+    try:
+        return filename, BADCtf('r', filename, **options), None
+    except Exception:
+        return filename, None, sys.exc_info()[1]
+
+
+class BADCtfStats:
+    ''' Time spent and counts for the phases of reading, checking and
+        writing badc text files. Pass one as stats to BADCtf (or to several
+        instances to add them up). The phases are metadata and colnames for
+        the header, data for the data rows, cache for a load from a
+        BADCtfCache, validate, check:<label> for the checks of each
+        MDinfo rule, and write:<fmt> for each export. times and counts are
+        keyed by phase; counts are of the records, columns, rows or checks
+        in each phase. Each callback is called with (phase, seconds, count)
+        as each phase ends.
+        '''
+    def __init__(self, callback=None):
+        self.times = {}
+        self.counts = {}
+        self.callbacks = []
+        if callback is not None:
+            self.callbacks.append(callback)
+
+    def register(self, callback):
+        self.callbacks.append(callback)
+
+    def add(self, phase, seconds, count=1):
+        self.times[phase] = self.times.get(phase, 0.0) + seconds
+        self.counts[phase] = self.counts.get(phase, 0) + count
+        for callback in self.callbacks:
+            callback(phase, seconds, count)
+
+    def reset(self):
+        self.times.clear()
+        self.counts.clear()
+
+    def __repr__(self):
+        # the phases, slowest first
+        phases = sorted(self.times, key=self.times.get, reverse=True)
+        return '\n'.join(['%-30s %10.6fs %10d' % (phase, self.times[phase],
+                                                  self.counts[phase])
+                          for phase in phases])
+
+
+class BADCtfReport:
+    ''' The problems found by BADCtf.validate. Each problem is a tuple
+        (label, ref, values, error) where ref is 'G' or a column name and
+        error is the exception that describes it. len() of a report is the
+        number of problems. '''
+    def __init__(self):
+        self.problems = []
+
+    def add(self, label, ref, values, error):
+        self.problems.append((label, ref, values, error))
+
+    def __len__(self):
+        return len(self.problems)
+
+    def __iter__(self):
+        return iter(self.problems)
+
+    def errors(self, cls=BADCtfError):
+        ''' Return the problems whose error is an instance of cls '''
+        return [p for p in self.problems if isinstance(p[3], cls)]
+
+    def raise_first(self):
+        ''' Raise the error of the first problem, if there is one '''
+        if self.problems:
+            raise self.problems[0][3]
+
+    def __repr__(self):
+        return '\n'.join(['%s,%s: %s' % (p[0], p[1], p[3]) for p in self.problems])
+
+
+class BADCtfReader:
+    ''' Reads the sections of a BADC text file from an open file handle.
+        The byte offset of the next unread line is kept in offset, so a
+        caller can find where each section starts. If end is given no
+        lines starting at or after that offset are read.
+        '''
+    def __init__(self, fh, offset=0, end=None):
+        self.fh = fh
+        self.offset = offset
+        self.end = end
+        self.done = False
+
+    def _lines(self):
+        # lines from the file handle, keeping track of the offset
+        while self.end is None or self.offset < self.end:
+            line = self.fh.readline()
+            if not line:
+                return
+            self.offset += len(line)
+            yield line
+
+    def read_header(self, tf=None):
+        ''' Read the metadata and column name sections into tf, or just
+        skip them if tf is None. Returns True if the column names were
+        found. The offset of the line after the data marker is kept in
+        header_end. If tf has stats, the time taken to read the metadata
+        and the column names is added to them. '''
+        stats = getattr(tf, 'stats', None)
+        if stats is not None:
+            start = time.time()
+            nrecords = (len(tf._metadata.globalRecords) +
+                        len(tf._metadata.varRecords))
+        section = 1
+        for row in csv.reader(self._lines()):
+          try:
+            while row and row[-1] == '': row=row[:-1] # remove blank cells
+            # section 1 is the metadata section 
+            if section == 1:
+                if len(row) == 0: continue        # ignore blank lines
+                elif len(row) == 1:
+                    if row[0].lower() == 'data':
+                        section = 2
+                        self.header_end = self.offset
+                        if stats is not None:
+                            stats.add('metadata', time.time()-start,
+                                      len(tf._metadata.globalRecords) +
+                                      len(tf._metadata.varRecords) - nrecords)
+                            start = time.time()
+                elif tf is not None:
+                    label, ref, values = row[0], row[1], row[2:]
+                    tf.add_metadata(label,tuple(values),ref)
+
+            # section 2 the column names
+            else:
+                if tf is not None:
+                    for colname in row:
+                        tf.add_variable(colname)
+                if stats is not None:
+                    stats.add('colnames', time.time()-start, len(row))
+                return True
+
+          except BADCtfError:
+              print row
+              raise
+        return False
+
+    def _split(self, line, lines):
+        # split one line into cells, dropping trailing blank cells. Lines
+        # with quotes go through csv, which may read on into lines when a
+        # quoted cell holds a newline.
+        if '"' in line:
+            row = next(csv.reader(itertools.chain((line,), lines)))
+            while row and row[-1] == '': row=row[:-1] # remove blank cells
+            return row
+        line = line.rstrip('\r\n').rstrip(',')
+        if not line:
+            return []
+        return line.split(',')
+
+    def rows(self):
+        ''' Yield the data rows up to the end data marker. The offset of
+        the start of the last row yielded is kept in row_offset. '''
+        self.done = False
+        lines = self._lines()
+        for line in lines:
+            self.row_offset = self.offset - len(line)
+            row = self._split(line, lines)
+            if len(row) > 1:
+                yield row
+            elif len(row) == 1 and row[0].lower() == 'end data':
+                break
+        self.done = True
+
+    def row_offsets(self):
+        ''' Yield the offset of the start of each data row up to the end
+        data marker, without splitting rows into cells. After each offset
+        is yielded, offset is the end of that row. At the end row_offset
+        is the offset of the end data line, or of the end of the file. '''
+        self.done = False
+        lines = self._lines()
+        self.row_offset = self.offset
+        for line in lines:
+            self.row_offset = self.offset - len(line)
+            if '"' in line:
+                row = self._split(line, lines)
+            else:
+                line = line.rstrip('\r\n').rstrip(',')
+                if ',' in line:
+                    yield self.row_offset
+                    continue
+                row = [line]
+            if len(row) > 1:
+                yield self.row_offset
+            elif len(row) == 1 and row[0].lower() == 'end data':
+                break
+        else:
+            self.row_offset = self.offset
+        self.done = True
+
+    def blocks(self, n, ncols, keep=None, test=None):
+        ''' Yield the data rows in blocks of up to n rows, each block a
+        list of ncols columns of cell strings, or only the columns at the
+        positions in keep. If test, a BADCtfRowFilter, is given only the
+        rows it passes are kept, and reading stops where it says to. A
+        block of plain lines (no quotes, ncols cells on every line, no
+        blank last cell, no end data line) is split in one go; any other block is re-read row
+        by row. '''
+        if keep is None:
+            keep = range(ncols)
+        self.done = False
+        while not self.done:
+            start = self.offset
+            lines = list(itertools.islice(self._lines(), n))
+            if not lines:
+                self.done = True
+                return
+            text = ''.join(lines)
+            # an end data line padded with commas has ncols cells too, and
+            # a row ending in a blank cell is short once rows() strips it
+            if (ncols > 1 and '"' not in text and
+                    set(l.count(',') for l in lines) == set([ncols-1]) and
+                    ',\n' not in text and ',\r' not in text and
+                    not text.endswith(',') and not END_DATA.search(text)):
+                text = text.replace('\r', '')
+                if text.endswith('\n'): text = text[:-1]
+                flat = text.replace('\n', ',').split(',')
+                if test is None:
+                    yield [flat[j::ncols] for j in keep]
+                    continue
+                mask = test.mask(lambda j: flat[j::ncols])
+                yield [list(itertools.compress(flat[j::ncols], mask))
+                       for j in keep]
+                if test.stopped:
+                    self.done = True
+                    return
+                continue
+            # irregular block: go back and read it a row at a time
+            self.fh.seek(start)
+            self.offset = start
+            rows = list(itertools.islice(self.rows(), n))
+            for row in rows:
+                if len(row) != ncols:
+                    raise BADCtfError("Wrong length of data: %s" % row)
+            if rows:
+                columns = zip(*rows)
+                if test is None:
+                    yield [list(columns[j]) for j in keep]
+                    continue
+                mask = test.mask(lambda j: columns[j])
+                yield [list(itertools.compress(columns[j], mask))
+                       for j in keep]
+                if test.stopped:
+                    self.done = True
+                    return
+
+
+class BADCtfRowFilter:
+    ''' Selects data rows by their cells as they are split. tests holds
+        (position, vtype, op, value) tuples: the cells at that position in
+        a row are compared with value using OPERATORS[op], as numbers for
+        int and float columns, and a row is kept if it passes every test.
+        A cell that is not a number fails. stop, a (position, vtype, value)
+        tuple, is for a column that increases down the file; the first row
+        with a cell at or past value, and any after it, are not kept and
+        stopped is set.
+        '''
+    def __init__(self, tests, stop=None):
+        self.tests = tests
+        self.stop = stop
+        self.stopped = False
+
+    def _numbers(self, cells, vtype):
+        # the cells of a column as numbers to compare, None where not one
+        if vtype not in ARRAY_TYPECODES:
+            return cells
+        try:
+            return map(float, cells)
+        except ValueError:
+            numbers = []
+            for cell in cells:
+                try:
+                    numbers.append(float(cell))
+                except ValueError:
+                    numbers.append(None)
+            return numbers
+
+    def mask(self, column):
+        ''' Return a list with a flag for each row of a block saying if it
+        is kept. column(j) returns the cells of the rows at position j. '''
+        mask = None
+        for j, vtype, op, value in self.tests:
+            compare = OPERATORS[op]
+            cells = self._numbers(column(j), vtype)
+            passed = [c is not None and compare(c, value) for c in cells]
+            if mask is None:
+                mask = passed
+            else:
+                mask = map(operator.and_, mask, passed)
+        if self.stop is not None:
+            j, vtype, value = self.stop
+            cells = self._numbers(column(j), vtype)
+            for i, cell in enumerate(cells):
+                if cell is not None and cell >= value:
+                    mask = mask[:i] + [False] * (len(mask)-i)
+                    self.stopped = True
+                    break
+        return mask
+
+
+class BADCtfRecords:
+    ''' The data records of a file that holds more than one, as a sequence
+        of BADCtf instances. The file is scanned once for the byte offsets
+        of each record (or the offsets are taken from a current
+        BADCtfIndex); getting record k then parses only that record.
+        offsets holds (start, data, end) for each record: the offsets of
+        its first metadata line, its first data row and its end data line.
+        '''
+    def __init__(self, filename):
+        self.filename = filename
+        index = BADCtfIndex.load(filename)
+        if index:
+            self.offsets = [(r['start'], r['data'], r['end'])
+                            for r in index.records]
+        else:
+            self.offsets = _scan_records(filename)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, k):
+        if type(k) == slice:
+            return [self[j] for j in range(*k.indices(len(self)))]
+        return BADCtf('r', self.filename, offset=self.offsets[k][0])
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+
+class BADCtfIndex:
+    ''' A sidecar index for a BADC text file, saved next to it with an
+        '.idx' suffix. records holds a dictionary for each data record with
+        the offsets of its first line (start), the end of its metadata
+        (header), its first data row (data) and its end data line (end),
+        its number of rows, and the offset of every every-th row. The size
+        and mtime of the file are kept so that a stale index is not used.
+        '''
+    def __init__(self, filename, every=1000):
+        self.filename = filename
+        self.every = every
+        stat = os.stat(filename)
+        self.size, self.mtime = stat.st_size, stat.st_mtime
+        self.records = []
+        if every:
+            self._build()
+
+    def _build(self):
+        fh = open(self.filename, 'rb')
+        try:
+            reader = BADCtfReader(fh)
+            while True:
+                start = reader.offset
+                if not reader.read_header():
+                    break
+                record = {'start': start, 'header': reader.header_end,
+                          'data': reader.offset}
+                rows, offsets = 0, []
+                for offset in reader.row_offsets():
+                    if rows % self.every == 0:
+                        offsets.append(offset)
+                    rows += 1
+                record.update(end=reader.row_offset, rows=rows,
+                              offsets=offsets)
+                self.records.append(record)
+        finally:
+            fh.close()
+
+    def record(self, start):
+        ''' Return the record starting at offset start, or None '''
+        for record in self.records:
+            if record['start'] == start:
+                return record
+
+    @staticmethod
+    def indexfile(filename):
+        return filename + '.idx'
+
+    def save(self):
+        f = open(BADCtfIndex.indexfile(self.filename), 'w')
+        try:
+            json.dump({'size': self.size, 'mtime': self.mtime,
+                       'every': self.every, 'records': self.records}, f)
+        finally:
+            f.close()
+
+    @staticmethod
+    def load(filename):
+        ''' Return the saved index for filename, or None if there is none
+        or the file has changed since it was made. '''
+        try:
+            f = open(BADCtfIndex.indexfile(filename))
+        except IOError:
+            return None
+        try:
+            state = json.load(f)
+        finally:
+            f.close()
+        index = BADCtfIndex(filename, every=None)
+        if (state['size'], state['mtime']) != (index.size, index.mtime):
+            return None
+        index.every = state['every']
+        index.records = state['records']
+        return index
+
+
+class BADCtfCache:
+    ''' A binary cache of a parsed BADC text file, saved next to it with
+        a '.cache' suffix. The file starts with CACHE_MAGIC and the length
+        of a JSON header, which holds the size, mtime and sha1 hash of the
+        source file, the metadata records, and the type and position of
+        each column's buffers. The buffers follow, each aligned to 8 bytes,
+        so a column can be mapped without reading the others. The cache is
+        stale if the size of the source has changed, or its mtime has
+        changed and its contents hash differently. BADCtf('r', filename,
+        cache=True) loads a current cache without parsing or validating
+        the file, or makes one if there is none and it can be written.
+        '''
+    @staticmethod
+    def cachefile(filename, offset=0):
+        if offset:
+            return '%s.%d.cache' % (filename, offset)
+        return filename + '.cache'
+
+    @staticmethod
+    def save(tf, filename, offset=0):
+        ''' Save the parsed tf, read from the record at offset in
+        filename, to its cache file '''
+        if not isinstance(tf._data, BADCtfData):
+            raise BADCtfError('Only parsed data can be cached')
+        stat = os.stat(filename)
+        buffers, columns, pos = [], [], 0
+        for name, variable in zip(tf._data.colnames, tf._data.variables):
+            column = {'name': name, 'vtype': variable.vtype, 'buffers': []}
+            if variable.vtype is None:
+                column['values'] = variable._values
+            elif variable.vtype == 'char':
+                parts = [(variable._offsets.typecode,
+                          variable._offsets.tostring()),
+                         ('c', bytes(variable._chars))]
+            else:
+                parts = [(ARRAY_TYPECODES[variable.vtype],
+                          variable._values.tostring())]
+            for typecode, data in parts if variable.vtype else ():
+                column['buffers'].append((typecode, pos, len(data)))
+                buffers.append(data + '\0' * (-len(data) % 8))
+                pos += len(data) + (-len(data) % 8)
+            columns.append(column)
+        state = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                 'sha1': _file_hash(filename), 'offset': offset,
+                 'globals': tf._metadata.globalRecords,
+                 'records': tf._metadata.varRecords, 'columns': columns}
+        BADCtfCache._write(BADCtfCache.cachefile(filename, offset), state,
+                           lambda f: map(f.write, buffers))
+
+    @staticmethod
+    def _write(cachefile, state, write_buffers):
+        # write the header for state, then the buffers with
+        # write_buffers(f), to a temporary file renamed over cachefile, so
+        # a reader never maps a cache that is half written
+        header = json.dumps(state, encoding='latin-1')
+        header += ' ' * (-(len(header) + 16) % 8)
+        tmpfile = '%s.%d.tmp' % (cachefile, os.getpid())
+        f = open(tmpfile, 'wb')
+        try:
+            try:
+                f.write(struct.pack('<8sQ', CACHE_MAGIC, len(header)))
+                f.write(header)
+                write_buffers(f)
+            finally:
+                f.close()
+            os.rename(tmpfile, cachefile)
+        except:
+            if os.path.exists(tmpfile): os.remove(tmpfile)
+            raise
+
+    @staticmethod
+    def load(tf, filename, offset=0):
+        ''' Fill tf from the cache of the record at offset in filename.
+        Returns False, leaving tf alone, if there is no current cache or
+        its buffers do not fit in it. If the source's mtime has changed
+        but not its contents, the cache is rewritten with the new mtime so
+        the next load need not hash the source again. The typed buffers
+        are numpy arrays over the mapped cache file (or copies if numpy is
+        not available) and char bytes are buffers over it, so nothing is
+        copied until the columns are changed. '''
+        cachefile = BADCtfCache.cachefile(filename, offset)
+        try:
+            f = open(cachefile, 'rb')
+        except IOError:
+            return False
+        try:
+            magic = f.read(16)
+            if len(magic) != 16:
+                return False
+            magic, n = struct.unpack('<8sQ', magic)
+            if magic != CACHE_MAGIC:
+                return False
+            try:
+                state = json.loads(f.read(n), encoding='latin-1')
+            except ValueError:
+                return False
+            stat = os.stat(filename)
+            if state['size'] != stat.st_size or state['offset'] != offset:
+                return False
+            if state['mtime'] != stat.st_mtime:
+                if state['sha1'] != _file_hash(filename):
+                    return False
+                state['mtime'] = stat.st_mtime
+                try:
+                    BADCtfCache._write(cachefile, state,
+                                       lambda out: shutil.copyfileobj(f, out))
+                except (IOError, OSError):
+                    pass
+            size = os.fstat(f.fileno()).st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        base = 16 + n
+        for column in state['columns']:
+            for typecode, start, length in column['buffers']:
+                if start < 0 or length < 0 or base + start + length > size:
+                    mm.close()
+                    return False
+        def view(typecode, start, size):
+            start += base
+            if typecode == 'c':
+                return buffer(mm, start, size)
+            if numpy is not None:
+                return numpy.frombuffer(mm, typecode, size // numpy.dtype(
+                    typecode).itemsize, start)
+            return array.array(typecode, mm[start:start+size])
+
+        for label, values in state['globals']:
+            tf.add_metadata(_latin1(label), _latin1(values), 'G')
+        for label, ref, values in state['records']:
+            tf.add_metadata(_latin1(label), _latin1(values), _latin1(ref))
+        for column in state['columns']:
+            variable = BADCtfVariable()
+            variable.vtype = column['vtype']
+            if variable.vtype is None:
+                variable._values = list(_latin1(column['values']))
+            elif variable.vtype == 'char':
+                variable._offsets, variable._chars = [
+                    view(*b) for b in column['buffers']]
+            else:
+                variable._values = view(*column['buffers'][0])
+            tf._data.variables.append(variable)
+            tf._data.colnames.append(_latin1(column['name']))
+        return True
+
+
+class BADCtfStream(BADCtf):
+    ''' A BADCtf whose data section is read lazily. The metadata and
+        column names are parsed and validated on opening; iterating over
+        the stream then yields the data rows one at a time from the open
+        file, so memory use does not depend on the size of the file. Rows
+        are not stored, so len() of a stream is 0. offset is the byte
+        offset of the record to read, and columns, where, between and
+        monotonic select the columns and rows to read, as for BADCtf.
+        '''
+    def __init__(self, filename, offset=0, columns=None, where=None,
+                 between=None, monotonic=False):
+        self.mode = 'r'
+        self._data = BADCtfData()
+        self._metadata = BADCtfMetadata()
+        self._decoded = {}
+        self.fh = open(filename, 'rb')
+        self.fh.seek(offset)
+        self._reader = BADCtfReader(self.fh, offset)
+        try:
+            if not self._reader.read_header(self):
+                raise BADCtfParseError('No data section in %s' % filename)
+            self._ncols = self.nvar()
+            self._test = self._row_filter(where, between, monotonic)
+            self._keep = self._select(columns)
+            self._check_valid()
+        except:
+            self.fh.close()
+            raise
+
+    def _take(self, row):
+        # the row to yield, after the width check, filter and column
+        # selection, or None if the filter drops it
+        if len(row) != self._ncols:
+            raise BADCtfError("Wrong length of data")
+        test = self._test
+        if test is not None and not test.mask(lambda j: [row[j]])[0]:
+            return None
+        if self._keep is not None:
+            row = [row[j] for j in self._keep]
+        return row
+
+    def __iter__(self):
+        for row in self._reader.rows():
+            row = self._take(row)
+            if row is None:
+                if self._test.stopped:
+                    return
+                continue
+            yield row
+
+    def arrays(self, n=BLOCKSIZE):
+        ''' Yield the data rows in blocks of up to n rows, each block a
+        list of numpy arrays, one per column, with the dtype given by the
+        column's type metadata. A column whose values do not all fit its
+        type is returned as a string array. Needs numpy. '''
+        if numpy is None:
+            raise BADCtfError('numpy is needed to read arrays')
+        dtypes = [NUMPY_TYPES.get(self._coltype(c), 'S')
+                  for c in self.colnames()]
+        for columns in self.columns(n):
+            arrays = []
+            for values, dtype in zip(columns, dtypes):
+                values = numpy.array(values, dtype='S')
+                try:
+                    values = values.astype(dtype)
+                except ValueError:
+                    pass
+                arrays.append(values)
+            yield arrays
+
+    def columns(self, n=BLOCKSIZE):
+        ''' Yield the data rows in blocks of up to n rows, each block a
+        list of columns of cell strings '''
+        return self._reader.blocks(n, self._ncols, self._keep, self._test)
+
+    def batches(self, n):
+        ''' Yield the data rows in lists of up to n rows '''
+        rows = iter(self)
+        while True:
+            batch = list(itertools.islice(rows, n))
+            if not batch:
+                return
+            yield batch
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BADCtfFollow(BADCtfStream):
+    ''' Follows a file as rows are added to it, like tail -f. The
+        metadata and column names are read once; poll then returns the
+        rows added since the last poll, and iterating waits for more. Only
+        complete rows are read (a quoted cell may hold newlines), so a row
+        still being written is read by a later poll. A row of the wrong
+        width raises BADCtfError once and is then skipped. position is the offset of the next line to read. An
+        end data line is not read past, and ended is set while the file
+        ends with it, so rows written over it (see mode 'a' of BADCtf) are
+        still found.
+        '''
+    def __init__(self, filename, offset=0, columns=None, where=None,
+                 between=None):
+        BADCtfStream.__init__(self, filename, offset, columns, where, between)
+        self.position = self._reader.offset
+        self.ended = False
+
+    def poll(self):
+        ''' Return a list of the rows added since the last poll, reading
+        at most FOLLOW_READ bytes '''
+        size = os.fstat(self.fh.fileno()).st_size
+        if size < self.position:
+            raise BADCtfError('File has been truncated')
+        # read past the buffering of fh, which may hold bytes that have
+        # since been written over
+        fd = self.fh.fileno()
+        os.lseek(fd, self.position, 0)
+        data = os.read(fd, min(size - self.position, FOLLOW_READ))
+        lines = data[:data.rfind('\n')+1].splitlines(True)
+        rows = []
+        self.ended = False
+        i = 0
+        while i < len(lines):
+            if '"' in lines[i]:
+                # a quoted cell may hold newlines: the row ends at the
+                # first line that leaves an even number of quotes, and is
+                # left for a later poll if that has not been written yet
+                quotes, n = lines[i].count('"'), 1
+                while quotes % 2 and i + n < len(lines):
+                    quotes += lines[i+n].count('"')
+                    n += 1
+                if quotes % 2:
+                    break
+                try:
+                    row = next(csv.reader(iter(lines[i:i+n])))
+                except csv.Error:
+                    row = []
+                while row and row[-1] == '': row=row[:-1] # remove blank cells
+            else:
+                row, n = lines[i].rstrip('\r\n').rstrip(',').split(','), 1
+            if len(row) == 1 and row[0].lower() == 'end data':
+                self.ended = True
+                break
+            if len(row) > 1:
+                try:
+                    row = self._take(row)
+                except BADCtfError:
+                    # return the rows before it; the next poll skips the
+                    # bad row as it raises
+                    if not rows:
+                        self.position += sum(map(len, lines[i:i+n]))
+                        raise
+                    break
+                if row is not None:
+                    rows.append(row)
+            self.position += sum(map(len, lines[i:i+n]))
+            i += n
+        return rows
+
+    def follow(self, interval=1.0, timeout=None, until_end=False):
+        ''' Yield the rows as they are added, polling every interval
+        seconds. Stops when no rows have been added for timeout seconds,
+        if timeout is given, or with until_end when the end data line is
+        reached. '''
+        idle = 0.0
+        while True:
+            rows = self.poll()
+            for row in rows:
+                yield row
+            if until_end and self.ended:
+                return
+            if rows:
+                idle = 0.0
+            elif timeout is not None and idle >= timeout:
+                return
+            else:
+                time.sleep(interval)
+                idle += interval
+
+    def __iter__(self):
+        return self.follow()
+
+
+class BADCtfWriter:
+    ''' Writes a BADC text file as it goes. The metadata, column names
+        and any data rows of tf are written when the writer is made; more
+        rows can then be written with append_rows, and close writes the
+        end data marker. Nothing is held back beyond the buffering of the
+        file. target is a filename or a writable file object, which is
+        left open.
+        '''
+    def __init__(self, tf, target):
+        if hasattr(target, 'write'):
+            self.fh, self._own = target, False
+        else:
+            self.fh, self._own = open(target, 'w'), True
+        self.nvar = tf.nvar()
+        self.csvwriter = csv.writer(self.fh, lineterminator='\n')
+        tf._metadata.csv(self.csvwriter)
+        self.csvwriter.writerow(('Data',))
+        self.csvwriter.writerow(tf.colnames())
+        self.csvwriter.writerows(tf._data.iter_rows())
+        self.closed = False
+
+    def append_rows(self, rows):
+        ''' Write rows, each a sequence with a value for every column '''
+        nvar, writerow = self.nvar, self.csvwriter.writerow
+        for row in rows:
+            if len(row) != nvar:
+                raise BADCtfError("Wrong length of data")
+            writerow(row)
+
+    def close(self):
+        if self.closed:
+            return
+        self.csvwriter.writerow(('End Data',))
+        self.closed = True
+        if self._own:
+            self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class BADCtfData:
     ''' Class to hold data in the files
         BADCtfData is an aggregation of variables
@@ -569,9 +2089,9 @@ class BADCtfData:
         self.variables = []
         self.colnames = []
         
-    def add_variable(self, name, values):
+    def add_variable(self, name, values, vtype=None):
         if len(self.variables) == 0 or len(values) == len(self.variables[0]):
-            self.variables.append(BADCtfVariable(values))
+            self.variables.append(BADCtfVariable(values, vtype))
             self.colnames.append(name)
         else:
             raise BADCtfError("Wrong length of data")
@@ -604,68 +2124,386 @@ class BADCtfData:
             col, row = i
             return self.variables[col][row]
 
+    def add_columns(self, columns):
+        ''' Append a block of rows given as one sequence per column '''
+        if len(columns) != self.nvar():
+            raise BADCtfError("Wrong length of data")
+        for variable, values in zip(self.variables, columns):
+            variable.extend(values)
+
+    def extend(self, other):
+        ''' Append the rows of another BADCtfData with the same columns '''
+        if other.nvar() != self.nvar():
+            raise BADCtfError("Wrong length of data")
+        for variable, values in zip(self.variables, other.variables):
+            variable.extend(values)
+
+    def strings(self, j, start=0, stop=None):
+        ''' Return values start to stop of column j as text '''
+        return self.variables[j].strings(start, stop)
+
     def getrow(self,i):
         row = []
         for j in range(self.nvar()):
             row.append(self.variables[j][i])
         return row
+
+    def row_blocks(self, chunk=BLOCKSIZE, strings=False):
+        ''' Yield the rows in lists of up to chunk tuples, each block
+        turned from slices of the columns into rows in one go. strings=True
+        gives the values as text, as they are written out. '''
+        for start in range(0, len(self), chunk):
+            if strings:
+                columns = [v.strings(start, start+chunk)
+                           for v in self.variables]
+            else:
+                columns = [v[start:start+chunk] for v in self.variables]
+            yield zip(*columns)
+
+    def iter_rows(self, chunk=BLOCKSIZE):
+        ''' Yield the rows as tuples, made chunk rows at a time '''
+        return itertools.chain.from_iterable(self.row_blocks(chunk))
         
     def csv(self, csvwriter):
         csvwriter.writerow(('Data',))
         csvwriter.writerow(self.colnames)
-        for i in range(len(self)):
-            csvwriter.writerow(self.getrow(i))
+        csvwriter.writerows(self.iter_rows())
+        csvwriter.writerow(('End Data',))
+
+class BADCtfMappedData:
+    ''' Read only data held in a memory mapped file. Only the start and
+        end offsets of each data row are kept; a row is split into cells,
+        and the cells converted to their column's type, when it is
+        accessed. Cells that do not fit their type are left as strings.
+        keep, if given, holds the positions of the cells of the columns.
+        Has the same interface as BADCtfData for reading.
+        '''
+    def __init__(self, mm, colnames, vtypes, starts, ends, keep=None):
+        self.mm = mm
+        self.keep = keep
+        self.colnames = list(colnames)
+        self.starts = starts
+        self.ends = ends
+        self._convert = [{'int': int, 'float': float}.get(v) for v in vtypes]
+
+    def _decode(self, value, j):
+        convert = self._convert[j]
+        if convert is None:
+            return value
+        try:
+            return convert(value)
+        except ValueError:
+            return value
+
+    def _cells(self, i):
+        # the cells of row i as strings
+        text = self.mm[self.starts[i]:self.ends[i]]
+        if '"' in text:
+            row = next(csv.reader(text.splitlines(True)))
+            while row and row[-1] == '': row=row[:-1] # remove blank cells
+        else:
+            row = text.rstrip('\r\n').rstrip(',').split(',')
+        if self.keep is not None:
+            return [row[j] for j in self.keep]
+        return row
+
+    def __len__(self):
+        return len(self.starts)
+
+    def nvar(self):
+        return len(self.colnames)
+
+    def __getitem__(self, i):
+        if type(i) == int:
+            return [self._decode(self._cells(k)[i], i)
+                    for k in range(len(self))]
+        else:
+            col, row = i
+            if type(row) == slice:
+                return [self._decode(self._cells(k)[col], col)
+                        for k in range(*row.indices(len(self)))]
+            return self._decode(self._cells(row)[col], col)
+
+    def getrow(self,i):
+        return [self._decode(v, j) for j, v in enumerate(self._cells(i))]
+
+    def row_blocks(self, chunk=BLOCKSIZE, strings=False):
+        ''' Yield the rows in lists of up to chunk tuples. strings=True
+        gives the cells as they are in the file, without decoding them. '''
+        columns = range(self.nvar())
+        for start in range(0, len(self), chunk):
+            rows = map(self._cells, range(start, min(start+chunk, len(self))))
+            if strings:
+                yield map(tuple, rows)
+            else:
+                yield [tuple(map(self._decode, row, columns)) for row in rows]
+
+    def iter_rows(self, chunk=BLOCKSIZE):
+        ''' Yield the rows as tuples, made chunk rows at a time '''
+        return itertools.chain.from_iterable(self.row_blocks(chunk))
+
+    def strings(self, j, start=0, stop=None):
+        ''' Return values start to stop of column j as text '''
+        return [self._cells(k)[j]
+                for k in range(*slice(start, stop).indices(len(self)))]
+
+    def add_variable(self, name, values, vtype=None):
+        raise BADCtfError("Mapped data is read only")
+
+    def add_data_row(self, values):
+        raise BADCtfError("Mapped data is read only")
+
+    def csv(self, csvwriter):
+        csvwriter.writerow(('Data',))
+        csvwriter.writerow(self.colnames)
+        csvwriter.writerows(self.iter_rows())
         csvwriter.writerow(('End Data',))
 
+    def close(self):
+        self.mm.close()
+
+
 class BADCtfVariable:
-    ''' class to hold 1D data '''
+    ''' class to hold 1D data. Columns with a known type are held in
+        compact buffers: an array.array for int and float, and an offsets
+        array into a single byte buffer for char. Untyped columns (vtype
+        None) are held in a plain list. Columns loaded from a BADCtfCache
+        hold read only views of the cache file instead, which are copied
+        into the usual buffers the first time values are added.
+        '''
 	    
-    def __init__(self, values=[]):
-        self.set_values(values)
+    def __init__(self, values=[], vtype=None):
+        self.set_values(values, vtype)
 
     def __len__(self):
-        return len(self.values)
+        if self.vtype == 'char':
+            return len(self._offsets)-1
+        return len(self._values)
 
     def __getitem__(self, i):
-        return self.values[i]
+        if type(i) == slice:
+            if self.vtype is None:
+                return self._values[i]
+            elif self.vtype != 'char':
+                return self._values[i].tolist()
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            if start >= stop:
+                return []
+            # decode the run of values from one copy of their bytes
+            offsets = self._offsets[start:stop+1].tolist()
+            base = offsets[0]
+            chars = bytes(self._chars[base:offsets[-1]])
+            return [chars[a-base:b-base]
+                    for a, b in itertools.izip(offsets, offsets[1:])]
+        if self.vtype != 'char':
+            return self._values[i]
+        n = len(self)
+        if i < 0: i += n
+        if i < 0 or i >= n:
+            raise IndexError('variable index out of range')
+        return bytes(self._chars[self._offsets[i]:self._offsets[i+1]])
+
+    def _convert(self, v):
+        # convert a value for storage in a numeric buffer
+        if self.vtype == 'int':
+            if isinstance(v, float) and v != int(v):
+                raise ValueError('%s is not an int' % v)
+            return int(v)
+        return float(v)
+
+    def _strings(self):
+        # the values as strings, as they would be written
+        if self.vtype in ARRAY_TYPECODES:
+            return [repr(v) for v in self._values.tolist()]
+        return self.values
+
+    def _own(self):
+        # copy storage mapped from a cache so that it can grow
+        if self.vtype == 'char' and not isinstance(self._chars, bytearray):
+            self._offsets = array.array('L', self._offsets.tostring())
+            self._chars = bytearray(self._chars)
+        elif (self.vtype in ARRAY_TYPECODES and
+              not isinstance(self._values, array.array)):
+            self._values = array.array(ARRAY_TYPECODES[self.vtype],
+                                       self._values.tostring())
+
+    def _to_char(self):
+        # fall back to char storage when a value does not fit the type
+        values = self._strings()
+        self.vtype = 'char'
+        self._chars = bytearray()
+        self._offsets = array.array('L', [0])
+        for v in values:
+            self.append(v)
 
     def append(self,v):
-        self.values.append(v)
-
-    def set_values(self, values):
-        self.values = list(values)
+        self._own()
+        if self.vtype is None:
+            self._values.append(v)
+        elif self.vtype == 'char':
+            self._chars.extend(str(v))
+            self._offsets.append(len(self._chars))
+        else:
+            try:
+                self._values.append(self._convert(v))
+            except (ValueError, TypeError, OverflowError):
+                self._to_char()
+                self.append(v)
+
+    def extend(self, values):
+        ''' Append a sequence of values, or the values of another
+        BADCtfVariable '''
+        self._own()
+        if isinstance(values, BADCtfVariable):
+            if values.vtype == self.vtype and self.vtype in ARRAY_TYPECODES:
+                self._values.fromstring(values._values.tostring())
+                return
+            elif values.vtype == self.vtype == 'char':
+                base = self._offsets[-1]
+                self._offsets.extend(array.array(
+                    'L', [o+base for o in values._offsets[1:].tolist()]))
+                self._chars.extend(bytes(values._chars))
+                return
+            elif values.vtype is None:
+                values = values._values
+            elif self.vtype is None:
+                values = values.values
+            else:
+                if self.vtype in ARRAY_TYPECODES: self._to_char()
+                values = values._strings()
+        if self.vtype is None:
+            self._values.extend(values)
+        elif self.vtype == 'char':
+            values = [str(v) for v in values]
+            self._chars.extend(''.join(values))
+            offsets = self._offsets
+            pos = offsets[-1]
+            for v in values:
+                pos += len(v)
+                offsets.append(pos)
+        else:
+            if values and isinstance(values[0], str):
+                # strings from a file, the builtins do the checking
+                convert = {'int': int, 'float': float}[self.vtype]
+            else:
+                convert = self._convert
+            try:
+                self._values.extend(
+                    array.array(self._values.typecode, map(convert, values)))
+            except (ValueError, TypeError, OverflowError):
+                self._to_char()
+                self.extend(values)
+
+    def set_values(self, values, vtype=None):
+        if vtype not in ARRAY_TYPECODES and vtype != 'char':
+            vtype = None
+        self.vtype = vtype
+        if vtype is None:
+            self._values = list(values)
+        elif vtype == 'char':
+            self._chars = bytearray()
+            self._offsets = array.array('L', [0])
+            for v in values:
+                self.append(v)
+        else:
+            try:
+                self._values = array.array(ARRAY_TYPECODES[vtype],
+                                           [self._convert(v) for v in values])
+            except (ValueError, TypeError, OverflowError):
+                self.set_values(values, 'char')
+
+    def strings(self, start=0, stop=None):
+        ''' Return values start to stop as they are written out '''
+        if self.vtype == 'float':
+            return map(repr, self._values[start:stop])
+        elif self.vtype == 'int':
+            return map(str, self._values[start:stop])
+        elif self.vtype == 'char':
+            return self[start:stop]
+        return map(_format_value, self._values[start:stop])
+
+    def __getstate__(self):
+        # pickle the buffers as raw bytes
+        if self.vtype == 'char':
+            return ('char', self._offsets.tostring(), bytes(self._chars))
+        elif self.vtype is None:
+            return (None, self._values)
+        return (self.vtype, self._values.tostring())
+
+    def __setstate__(self, state):
+        self.vtype = state[0]
+        if self.vtype == 'char':
+            self._offsets = array.array('L')
+            self._offsets.fromstring(state[1])
+            self._chars = bytearray(state[2])
+        elif self.vtype is None:
+            self._values = state[1]
+        else:
+            self._values = array.array(ARRAY_TYPECODES[self.vtype])
+            self._values.fromstring(state[1])
+
+    @property
+    def values(self):
+        ''' The column as a list of Python values (a copy) '''
+        if self.vtype == 'char':
+            return self[:]
+        if self.vtype is None:
+            return list(self._values)
+        return self._values.tolist()
+
+    def buffers(self):
+        ''' Return the underlying storage without copying: the typed
+        array for int and float columns, (offsets, bytes) for char columns
+        where value i is bytes[offsets[i]:offsets[i+1]], or the list for
+        untyped columns. Arrays support the buffer protocol, so e.g.
+        numpy.frombuffer can wrap them without a copy. '''
+        if self.vtype == 'char':
+            return self._offsets, self._chars
+        return self._values
 
         
 class BADCtfMetadata:
-    ''' Holds the text file metadata. '''
+    ''' Holds the text file metadata. Records are kept in order in
+        globalRecords and varRecords, and indexed by label, by column and
+        by (label, column) for lookups. Add records with add_record so the
+        indexes stay in step with the lists. '''
     
     def __init__(self):
         # records use label as key, with value as content
         self.globalRecords = []
         self.varRecords = []
+        self._global = {}      # label -> global values
+        self._bylabel = {}     # label -> column values, all columns
+        self._bycol = {}       # column -> (label, values)
+        self._bylabelcol = {}  # (label, column) -> values
 
     def __getitem__(self, i):
         # if the item is selected with a label and a column name then
         # use get the metadata record for the column. otherwise use expect the
         # metadata label for global
-        val = []
         if type(i) == tuple:
             lab, col = i
-            for label, value in self.globalRecords:
-                if lab ==label:
-                    val.append(value)
-
-            for label, column, value in self.varRecords:
-                if (lab == label) and (col==column or col=='*'):
-                    val.append(value) 
-                elif (lab =='*') and (col==column):
-                    val.append((label,value))
+            val = list(self._global.get(lab, ()))
+            if lab == '*' and col == '*':
+                # only matches records literally labelled or referenced '*'
+                for label, column, value in self.varRecords:
+                    if label == '*':
+                        val.append(value)
+                    elif column == '*':
+                        val.append((label,value))
+            elif col == '*':
+                val.extend(self._bylabel.get(lab, ()))
+            elif lab == '*':
+                for label, value in self._bycol.get(col, ()):
+                    if label == '*': val.append(value)
+                    else: val.append((label,value))
+            else:
+                val.extend(self._bylabelcol.get((lab, col), ()))
+            return val
         else:
-            lab = i
-            for label, value in self.globalRecords:
-                if lab ==label:
-                    val.append(value)
-        return val
+            return list(self._global.get(i, ()))
 
     def __eq__(self,other):
         ''' test metadata equivalence '''
@@ -682,12 +2520,20 @@ class BADCtfMetadata:
         if type(values) != tuple: values = (values,)
         if type(ref)== str and ref=='G':
             self.globalRecords.append((label,values))
+            self._global.setdefault(label, []).append(values)
         elif type(ref) ==str:
             self.varRecords.append((label,ref,values))        
+            self._bylabel.setdefault(label, []).append(values)
+            self._bycol.setdefault(ref, []).append((label, values))
+            self._bylabelcol.setdefault((label, ref), []).append(values)
            
     def cdl(self):
         # return cdl representation of metadata
-        s = "// variable attributes\n"
+        return ''.join(self.cdl_chunks())
+
+    def cdl_chunks(self):
+        # yield the cdl representation of metadata a line at a time
+        yield "// variable attributes\n"
         # make sure labels are unique for netCDF. e.g. creator, creator1, creator2
         used_labels = {}
         for label, column, values in self.varRecords:
@@ -697,10 +2543,10 @@ class BADCtfMetadata:
             else:
                 use_label = label
                 used_labels[label, column] = 1
-            value = string.join(values, ', ')
-            s =s+'        %s:%s = "%s";\n' % (column, use_label, value)
+            value = _cdl_string(string.join(values, ', '))
+            yield '        %s:%s = %s;\n' % (column, use_label, value)
 
-        s=s+"\n// global attributes\n"
+        yield "\n// global attributes\n"
         used_labels = {}
         for label, values in self.globalRecords:
             if used_labels.has_key(label):
@@ -709,9 +2555,8 @@ class BADCtfMetadata:
             else:
                 use_label = label
                 used_labels[label] = 1        
-            value = string.join(values, ', ')
-            s=s+'        :%s = "%s";\n' % (use_label, value)
-        return s
+            value = _cdl_string(string.join(values, ', '))
+            yield '        :%s = %s;\n' % (use_label, value)
 
     def csv(self, csvwriter):
         for label, values in self.globalRecords:
@@ -781,7 +2626,9 @@ class testBADCtf(unittest.TestCase):
         self.t=self._makeDummy()
         
     def tearDown(self):
-        for f in [self.dummycsv,self.dummycdl,self.dummyna]:
+        for f in [self.dummycsv,self.dummycdl,self.dummyna,
+                  BADCtfIndex.indexfile(self.dummycsv),
+                  BADCtfCache.cachefile(self.dummycsv)]:
             if os.path.exists(f): os.remove(f)
         
     def testMake(self):
@@ -834,6 +2681,524 @@ class testBADCtf(unittest.TestCase):
         print '\n%I: Some warnings expected wrt checking standard names'
         t=BADCtf('r',self.sample)
         self.assertEqual(t.nvar(),35)
+
+    def testStream(self):
+        ''' streaming the example file gives the same rows '''
+        t=BADCtf('r',self.sample)
+        stream=BADCtf.open_stream(self.sample)
+        self.assertEqual(stream,t)
+        self.assertEqual(stream.colnames(),t.colnames())
+        rows=list(stream)
+        stream.close()
+        self.assertEqual(len(rows),len(t))
+        self.assertEqual(rows[-1][11:13],t._data.getrow(len(t)-1)[11:13])
+
+    def testStreamBatches(self):
+        ''' stream batches hold at most n rows '''
+        with BADCtf.open_stream(self.sample) as stream:
+            sizes=[len(b) for b in stream.batches(3)]
+        self.assertEqual(sizes,[3,3,2])
+
+    def testStreamArrays(self):
+        ''' the batch reader gives typed numpy columns '''
+        if numpy is None: return
+        with BADCtf.open_stream(self.sample) as stream:
+            blocks=list(stream.arrays(5))
+        self.assertEqual([len(b[0]) for b in blocks],[5,3])
+        self.assertEqual(blocks[0][0].dtype,numpy.dtype('i8'))
+        self.assertEqual(blocks[0][15].dtype,numpy.dtype('f8'))
+        self.assertEqual(blocks[1][12][-1],'EU0362')
+
+    def testIrregularData(self):
+        ''' quoted cells holding commas and newlines are read '''
+        self.t.add_variable('note',('a','b,c','d\ne','f'))
+        self.t.add_metadata('type','char','note')
+        self.t.write(self.dummycsv)
+        t2=BADCtf('r',self.dummycsv)
+        self.assertEqual(t2[3],['a','b,c','d\ne','f'])
+        self.assertEqual(t2[0],[6,12,18,24])
+
+    def testMetadataLookup(self):
+        ''' indexed lookups give the records in file order '''
+        m=BADCtfMetadata()
+        m.add_record('creator','A')
+        m.add_record('long_name',('T','K'),'temp')
+        m.add_record('type','float','temp')
+        m.add_record('long_name',('P','hPa'),'press')
+        m.add_record('creator','B')
+        self.assertEqual(m['creator'],[('A',),('B',)])
+        self.assertEqual(m['long_name','press'],[('P','hPa')])
+        self.assertEqual(m['long_name','*'],[('T','K'),('P','hPa')])
+        self.assertEqual(m['*','temp'],[('long_name',('T','K')),('type',('float',))])
+        self.assertEqual(m['creator','temp'],[('A',),('B',)])
+        self.assertEqual(m['title'],[])
+
+    def testValidateReport(self):
+        ''' validation reports every problem instead of raising '''
+        t=makeBadDummy()
+        t.add_metadata('title','A title','temp')
+        t.add_metadata('Conventions',('BADC-CSV','2'))
+        report=t.validate('basic')
+        self.assertEqual(len(report.errors(BADCtfMetadataInvalid)),2)
+        missing=report.errors(BADCtfMetadataIncomplete)
+        self.assertEqual(len([p for p in missing if p[0]=='long_name']),3)
+        self.assertRaises(BADCtfMetadataInvalid,report.raise_first)
+        self.assertEqual(len(self.t.validate('basic')),0)
+
+    def testReadMany(self):
+        ''' many files are read on a pool, errors are returned '''
+        self.t.write(self.dummycsv)
+        files=[self.dummycsv,self.sample,'no-such-file.csv']
+        results=dict((f,(t,e)) for f,t,e in BADCtf.read_many(files,workers=2))
+        self.assertEqual(sorted(results),sorted(files))
+        self.assertEqual(results[self.sample][0].nvar(),35)
+        self.assertEqual(results[self.dummycsv][0][0],[6,12,18,24])
+        self.assertEqual(results[self.sample][0][12][0],'EU6349')
+        self.assertTrue(isinstance(results['no-such-file.csv'][1],IOError))
+
+    def testParallelParse(self):
+        ''' parsing in byte ranges gives the same data '''
+        t=BADCtf('r',self.sample)
+        t2=BADCtf('r',self.sample,workers=3)
+        self.assertEqual(len(t2),len(t))
+        for i in range(t.nvar()):
+            self.assertEqual(t2[i],t[i])
+        self.t.add_variable('note',('a','b,\nc','"d"\n\ne','f'))
+        self.t.add_metadata('type','char','note')
+        self.t.write(self.dummycsv)
+        t3=BADCtf('r',self.dummycsv,workers=4)
+        self.assertEqual(t3[3],['a','b,\nc','"d"\n\ne','f'])
+
+    def testRecords(self):
+        ''' each data record in a file can be read on its own '''
+        records=BADCtf.records(self.sample)
+        self.assertEqual(len(records),2)
+        self.assertEqual(records[0],BADCtf('r',self.sample))
+        start,data,end=records.offsets[1]
+        f=open(self.sample,'rb')
+        f.seek(start)
+        self.assertEqual(f.readline(),'Conventions,G,BADC-CSV,1\r\n')
+        f.seek(end)
+        self.assertEqual(f.readline(),'end data\r\n')
+        f.close()
+        # the second record uses metadata that is not checkable yet
+        self.assertRaises(BADCtfMetadataInvalid,records.__getitem__,1)
+
+    def testIndex(self):
+        ''' the index finds records and row windows '''
+        t=BADCtf('r',self.sample)
+        t.write(self.dummycsv)
+        index=BADCtfIndex(self.dummycsv,every=3)
+        index.save()
+        self.assertEqual(index.records[0]['rows'],8)
+        self.assertEqual(len(index.records[0]['offsets']),3)
+        self.assertEqual(BADCtfIndex.load(self.dummycsv).records,index.records)
+        for rows in [(4,7),(0,3),(6,100),slice(7,None)]:
+            t2=BADCtf('r',self.dummycsv,rows=rows)
+            if type(rows)==tuple: rows=slice(*rows)
+            self.assertEqual(t2[12],t[12][rows])
+            self.assertEqual(t2[0],t[0][rows])
+        os.utime(self.dummycsv,(0,0))
+        self.assertEqual(BADCtfIndex.load(self.dummycsv),None)
+        os.remove(BADCtfIndex.indexfile(self.dummycsv))
+        t3=BADCtf('r',self.dummycsv,rows=(2,5))
+        self.assertEqual(t3[12],t[12][2:5])
+
+    def testCache(self):
+        ''' a cached file loads without parsing, until it changes '''
+        t=BADCtf('r',self.sample)
+        t.write(self.dummycsv)
+        t1=BADCtf('r',self.dummycsv,cache=True)
+        self.assertTrue(os.path.exists(BADCtfCache.cachefile(self.dummycsv)))
+        t2=BADCtf('r',self.dummycsv,cache=True)
+        self.assertEqual(t2,t1)
+        self.assertEqual(t2.colnames(),t1.colnames())
+        for j in range(t1.nvar()):
+            self.assertEqual(t2[j],t1[j])
+            self.assertEqual(t2._data.variables[j].vtype,
+                             t1._data.variables[j].vtype)
+        if numpy is not None:
+            # loaded without copying
+            self.assertTrue(isinstance(t2._data.variables[0]._values,
+                                       numpy.ndarray))
+        t2.add_datarecord(t1._data.getrow(0))
+        self.assertEqual(t2[0],t1[0]+t1[0][:1])
+        self.assertEqual(t2[12],t1[12]+t1[12][:1])
+        self.assertEqual(BADCtf('r',self.dummycsv,cache=True)[13],t[13])
+        # touched but unchanged files still use the cache
+        os.utime(self.dummycsv,(0,0))
+        self.assertTrue(BADCtfCache.load(BADCtf(),self.dummycsv))
+        # and the cache now holds the new mtime, so is not hashed again
+        cachefile=BADCtfCache.cachefile(self.dummycsv)
+        f=open(cachefile,'rb')
+        n=struct.unpack('<8sQ',f.read(16))[1]
+        self.assertEqual(json.loads(f.read(n))['mtime'],0)
+        f.close()
+        self.assertEqual([name for name in os.listdir('.') if name.endswith('.tmp')],[])
+        self.assertTrue(BADCtfCache.load(BADCtf(),self.dummycsv))
+        # a cut short cache is not used
+        data=open(cachefile,'rb').read()
+        open(cachefile,'wb').write(data[:-8])
+        t3=BADCtf()
+        self.assertEqual(BADCtfCache.load(t3,self.dummycsv),False)
+        self.assertEqual((t3.nvar(),t3['title']),(0,[]))
+        open(cachefile,'wb').write(data)
+        f=open(self.dummycsv,'r+b')
+        f.seek(-20,2)
+        f.write('9')
+        f.close()
+        self.assertEqual(BADCtfCache.load(BADCtf(),self.dummycsv),False)
+        # a cache that cannot be written is left out
+        os.remove(cachefile)
+        os.mkdir(cachefile)
+        try:
+            self.assertEqual(BADCtf('r',self.dummycsv,cache=True)[13],t[13])
+        finally:
+            os.rmdir(cachefile)
+        self.assertEqual([name for name in os.listdir('.') if name.endswith('.tmp')],[])
+
+    def testColumns(self):
+        ''' only the selected columns are read '''
+        t=BADCtf('r',self.sample)
+        t.write(self.dummycsv)
+        names=['13','1','16']
+        for kwargs in [{},{'mapped':True},{'rows':(2,6)},{'workers':2}]:
+            t2=BADCtf('r',self.dummycsv,columns=names,**kwargs)
+            rows=slice(*kwargs.get('rows',(None,)))
+            self.assertEqual(t2.colnames(),tuple(names))
+            self.assertEqual(t2[0],t[12][rows])
+            self.assertEqual(t2[1],t[0][rows])
+            self.assertEqual(t2[2],t[15][rows])
+            self.assertEqual(t2['long_name','35'],t['long_name','35'])
+        self.assertRaises(BADCtfError,BADCtf,'r',self.dummycsv,columns=['x'])
+        stream=BADCtf.open_stream(self.dummycsv,columns=names)
+        self.assertEqual(list(stream)[0],[t[12][0],'2009','4480.0'])
+        stream.close()
+        stream=BADCtf.open_stream(self.dummycsv,columns=names)
+        self.assertEqual(list(stream.arrays())[0][1].tolist(),t[0])
+        stream.close()
+
+    def testWhere(self):
+        ''' rows are filtered as they are read '''
+        self.t.write(self.dummycsv)
+        for kwargs in [{},{'workers':2},{'rows':(1,4)}]:
+            t=BADCtf('r',self.dummycsv,between=(10,20),**kwargs)
+            self.assertEqual(t[0],[12,18])
+            self.assertEqual(t[1],[303.4,305.6])
+        t=BADCtf('r',self.dummycsv,where=[('press','>',1004.4)],
+                 columns=['temp'])
+        self.assertEqual(t[0],[305.6,305.2])
+        t=BADCtf('r',self.dummycsv,between=(None,18),monotonic=True,
+                 where=[('temp','!=',301.2)])
+        self.assertEqual(t[0],[12])
+        self.assertRaises(BADCtfError,BADCtf,'r',self.dummycsv,
+                          where=[('temp','~',1)])
+        # values given as strings are compared as numbers
+        t=BADCtf('r',self.dummycsv,where=[('time','>=','12')],
+                 between=('0','19'))
+        self.assertEqual(t[0],[12,18])
+        self.assertRaises(BADCtfError,BADCtf,'r',self.dummycsv,
+                          where=[('temp','>','warm')])
+        stream=BADCtf.open_stream(self.dummycsv,between=(12,None))
+        self.assertEqual([row[0] for row in stream],['12','18','24'])
+        stream.close()
+        stream=BADCtf.open_stream(self.dummycsv,between=(7,19),monotonic=True)
+        self.assertEqual(list(stream.arrays())[0][0].tolist(),[12,18])
+        stream.close()
+        # columns with no type are compared as numbers with numbers
+        lines=open(self.dummycsv).readlines()
+        open(self.dummycsv,'w').writelines([l for l in lines
+                                            if not l.startswith('type,')])
+        t=BADCtf('r',self.dummycsv,where=[('temp','>',304)])
+        self.assertEqual(t[1],['305.6','305.2'])
+        t=BADCtf('r',self.dummycsv,between=(7,19))
+        self.assertEqual(t[0],['12','18'])
+
+    def testDecoded(self):
+        ''' decoded values are masked, scaled and offset '''
+        t=self.t
+        t.add_metadata('scale_factor','2','temp')
+        t.add_metadata('add_offset','1','temp')
+        t.add_metadata('valid_max','305','G')
+        t.add_metadata('valid_max','305.3','temp')
+        t.add_metadata('valid_range',('1003','1010'),'press')
+        temp=t.decoded('temp')
+        self.assertEqual(temp.tolist(),[603.4,607.8,None,611.4])
+        self.assertTrue(t.decoded(1) is temp)
+        press=t.decoded('press')
+        self.assertEqual(press.mask.tolist(),[True,False,False,True])
+        self.assertEqual(t.decoded('time').tolist(),[6,12,18,24])
+        t.add_datarecord((30,300.0,1000.0))
+        self.assertEqual(len(t.decoded('temp')),5)
+        t.write(self.dummycsv)
+        t2=BADCtf('r',self.dummycsv,mapped=True)
+        self.assertEqual(t2.decoded('temp').tolist(),t.decoded('temp').tolist())
+        self.assertEqual(t2.decoded(0).dtype.kind,'f')
+
+    def testDecodedTypes(self):
+        ''' char columns stay strings; bad cells of number columns are masked '''
+        t=self.t
+        t.add_variable('station',('03772','03772','3772','x'))
+        t.add_metadata('type','char','station')
+        t.add_variable('count',('1','x','n/a','4'))
+        t.add_metadata('type','int','count')
+        self.assertEqual(t.decoded('station').tolist(),['03772','03772','3772','x'])
+        self.assertEqual(t.decoded('count').tolist(),[1,None,None,4])
+        t.write(self.dummycsv)
+        t2=BADCtf('r',self.dummycsv)
+        self.assertEqual(t2.decoded('station')[0],'03772')
+        self.assertEqual(t2.decoded('count').mask.tolist(),[False,True,True,False])
+
+    def testIterRows(self):
+        ''' rows are taken from the columns a block at a time '''
+        t=BADCtf('r',self.sample)
+        rows=list(t._data.iter_rows(chunk=3))
+        self.assertEqual(len(rows),len(t))
+        self.assertEqual([list(row) for row in rows],
+                         [t._data.getrow(i) for i in range(len(t))])
+        blocks=list(t._data.row_blocks(3,strings=True))
+        self.assertEqual(map(len,blocks),[3,3,2])
+        self.assertEqual(list(blocks[2][1]),
+                         [t._data.strings(j,7,8)[0] for j in range(t.nvar())])
+        t2=BADCtf('r',self.sample,mapped=True)
+        self.assertEqual(list(t2._data.iter_rows(chunk=5)),rows)
+
+    def testStats(self):
+        ''' phases are timed and counted when asked '''
+        self.t.write(self.dummycsv)
+        calls=[]
+        stats=BADCtfStats(lambda *args: calls.append(args[0]))
+        t=BADCtf('r',self.dummycsv,stats=stats)
+        self.assertEqual(calls[:4],['metadata','colnames','data','check:Conventions'])
+        self.assertEqual(calls[-1],'validate')
+        self.assertEqual(stats.counts['metadata'],
+                         len(t._metadata.globalRecords)+len(t._metadata.varRecords))
+        self.assertEqual(stats.counts['colnames'],3)
+        self.assertEqual(stats.counts['data'],4)
+        self.assertEqual(stats.counts['check:long_name'],3)
+        t.write(self.dummycdl,'cdl')
+        self.assertEqual(stats.counts['write:cdl'],4)
+        self.assertTrue(stats.times['data']>=0)
+        self.assertTrue('check:type' in repr(stats))
+        self.assertEqual(BADCtf('r',self.dummycsv).stats,None)
+
+    def testAppend(self):
+        ''' rows are added to the end of an existing file '''
+        self.t.write(self.dummycsv)
+        with BADCtf('a',self.dummycsv) as t:
+            self.assertEqual(t.colnames(),('time','temp','press'))
+            t.append_rows([(30,306.0,1016.5),(36,307.5,1017.0)])
+            self.assertRaises(BADCtfError,t.append_rows,[(42,1.0,2.0),(48,1.0)])
+            t.add_datarecord((42,308.25,1018.0))
+        t2=BADCtf('r',self.dummycsv)
+        self.assertEqual(t2[0],[6,12,18,24,30,36,42])
+        self.assertEqual(t2[2][-3:],[1016.5,1017.0,1018.0])
+        self.assertTrue(open(self.dummycsv).read().endswith('\nEnd Data\n'))
+        # line endings and trailing commas of the end data line
+        text=open(self.dummycsv).read().replace('End Data','end data,,')
+        open(self.dummycsv,'wb').write(text.replace('\n','\r\n'))
+        t=BADCtf('a',self.dummycsv)
+        t.append_rows([(48,309.0,1019.0)])
+        t.close()
+        text=open(self.dummycsv,'rb').read()
+        self.assertTrue(text.endswith('42,308.25,1018.0\r\n48,309.0,1019.0\r\nEnd Data\r\n'))
+        self.assertEqual(BADCtf('r',self.dummycsv)[0][-2:],[42,48])
+        # with no end data line the rows go at the end of the file
+        text=open(self.dummycsv,'rb').read().replace('End Data\r\n','')
+        open(self.dummycsv,'wb').write(text[:-2])
+        with BADCtf('a',self.dummycsv) as t:
+            t.append_rows([(54,310.0,1020.0)])
+        text=open(self.dummycsv,'rb').read()
+        self.assertTrue(text.endswith('48,309.0,1019.0\r\n54,310.0,1020.0\r\nEnd Data\r\n'))
+        # the index shows that the first record is not the last
+        open(self.dummycsv,'wb').write(open(self.sample,'rb').read())
+        BADCtfIndex(self.dummycsv).save()
+        self.assertRaises(BADCtfError,BADCtf,'a',self.dummycsv)
+        # and without an index, the end data lines show it
+        os.remove(BADCtfIndex.indexfile(self.dummycsv))
+        self.t.write(self.dummycsv)
+        text=open(self.dummycsv,'rb').read()
+        open(self.dummycsv,'wb').write(text+text)
+        self.assertRaises(BADCtfError,BADCtf,'a',self.dummycsv)
+        self.assertEqual(open(self.dummycsv,'rb').read(),text+text)
+        with BADCtf('a',self.dummycsv,offset=len(text)) as t:
+            t.append_rows([(30,306.0,1016.5)])
+        records=BADCtf.records(self.dummycsv)
+        self.assertEqual([len(tf) for tf in records],[4,5])
+
+    def testFollow(self):
+        ''' a followed file gives the rows added since the last poll '''
+        self.t.write(self.dummycsv)
+        tail=BADCtf.tail(self.dummycsv,columns=['temp','time'])
+        self.assertEqual(tail.poll(),[['301.2','6'],['303.4','12'],
+                                      ['305.6','18'],['305.2','24']])
+        self.assertTrue(tail.ended)
+        self.assertEqual(tail.poll(),[])
+        with BADCtf('a',self.dummycsv) as t:
+            t.append_rows([(30,306.0,1016.5)])
+            self.assertEqual(tail.poll(),[['306.0','30']])
+            t.add_datarecord((36,307.0,1017.5))
+        f=open(self.dummycsv,'r+b')
+        f.seek(-len('End Data\n'),2)
+        f.write('42,"308')
+        f.truncate()
+        f.flush()
+        self.assertEqual(tail.poll(),[['307.0','36']])
+        self.assertEqual(tail.ended,False)
+        f.write('.5",1018.5\n')
+        f.flush()
+        self.assertEqual(list(tail.follow(interval=0.01,timeout=0.02)),
+                         [['308.5','42']])
+        f.write('48,309,1\nend data\n')
+        f.close()
+        self.assertEqual(list(tail.follow(until_end=True)),[['309','48']])
+        tail.close()
+
+    def testFollowSplitRows(self):
+        ''' rows still being written are left for a later poll, and a bad
+        row is raised once '''
+        self.t.write(self.dummycsv)
+        tail=BADCtf.tail(self.dummycsv)
+        self.assertEqual(len(tail.poll()),4)
+        f=open(self.dummycsv,'r+b')
+        f.seek(-len('End Data\n'),2)
+        f.write('30,1,"line one\n')
+        f.truncate()
+        f.flush()
+        self.assertEqual(tail.poll(),[])
+        f.write('line two"\n36,2\n42,3,4\n')
+        f.flush()
+        self.assertEqual(tail.poll(),[['30','1','line one\nline two']])
+        self.assertRaises(BADCtfError,tail.poll)
+        self.assertEqual(tail.poll(),[['42','3','4']])
+        f.close()
+        tail.close()
+
+    def testCheckData(self):
+        ''' data cells are checked against their type and valid range '''
+        t=self.t
+        t.add_datarecord((30,'x',1000.0))
+        t.add_datarecord((36,'',1020.0))
+        t.add_datarecord((42,'1e3',1009.0))
+        t.add_metadata('valid_max','1010','press')
+        t.add_metadata('valid_min','302','temp')
+        report=t.check_data()
+        self.assertEqual([p[:3] for p in report],
+                         [('type','temp',(4,5)),('valid_range','temp',(0,)),
+                          ('valid_range','press',(3,5))])
+        self.assertEqual(str(report.problems[0][3]),'2 cells of column temp are not float')
+        t.write(self.dummycsv)
+        t2=BADCtf('r',self.dummycsv,mapped=True)
+        self.assertEqual([p[:3] for p in t2.check_data()],[p[:3] for p in report])
+        self.assertEqual(len(t2.validate(data=True)),3)
+        t3=BADCtf('r',self.sample)
+        self.assertEqual([(p[0],p[1],len(p[2])) for p in t3.check_data()],
+                         [('type','14',8),('type','15',8)])
+
+    def testPaddedEndData(self):
+        ''' an end data line padded to the columns ends the data '''
+        self.t.write(self.dummycsv)
+        text=open(self.dummycsv).read().replace('End Data','End Data,,')
+        open(self.dummycsv,'w').write(text+'\n')
+        t=BADCtf('r',self.dummycsv)
+        self.assertEqual(len(t),4)
+        self.assertEqual(t[0],[6,12,18,24])
+        stream=BADCtf.open_stream(self.dummycsv)
+        self.assertEqual(list(stream.arrays())[0][0].tolist(),[6,12,18,24])
+        stream.close()
+
+    def testBlankLastCell(self):
+        ''' a row with a blank last cell is short, with or without quotes
+        elsewhere in the block '''
+        self.t.write(self.dummycsv)
+        text=open(self.dummycsv).read().replace('12,303.4,1004.4','12,303.4,')
+        for quoted in (text,text.replace('18,','"18",')):
+            open(self.dummycsv,'w').write(quoted)
+            self.assertRaises(BADCtfError,BADCtf,'r',self.dummycsv)
+            # in blocks of two, which leave the end data line out
+            f=open(self.dummycsv,'rb')
+            reader=BADCtfReader(f)
+            reader.read_header()
+            self.assertRaises(BADCtfError,list,reader.blocks(2,3))
+            f.close()
+
+    def testMapped(self):
+        ''' a mapped file decodes the same values on access '''
+        t=BADCtf('r',self.sample)
+        t2=BADCtf('r',self.sample,mapped=True)
+        self.assertEqual(len(t2),len(t))
+        self.assertEqual(t2._data.getrow(3),t._data.getrow(3))
+        self.assertEqual(t2[12],t[12])
+        self.assertEqual(t2._data[15,7],t._data[15,7])
+        self.assertRaises(BADCtfError,t2.add_datarecord,t._data.getrow(0))
+        t2.write(self.dummycsv)
+        self.assertEqual(BADCtf('r',self.dummycsv)[13],t[13])
+
+    def testWriter(self):
+        ''' rows can be appended to a file as it is written '''
+        with self.t.open_writer(self.dummycsv) as writer:
+            writer.append_rows([(30,306.1,1016.0),(36,307.2,1017.5)])
+            self.assertRaises(BADCtfError,writer.append_rows,[(42,)])
+        t2=BADCtf('r',self.dummycsv)
+        self.assertEqual(t2[0],[6,12,18,24,30,36])
+        s=StringIO.StringIO()
+        self.t.write(s)
+        self.assertEqual(s.getvalue(),self.t._csv())
+
+    def testCDLData(self):
+        ''' CDL data values are typed and wrapped '''
+        self.t.add_variable('note',('a','b"c','d','e'))
+        self.t.add_metadata('type','char','note')
+        cdl=self.t._cdl()
+        self.assertTrue('time = 6, 12, 18, 24 ;' in cdl)
+        self.assertTrue('temp = 301.2, 303.4, 305.6, 305.2 ;' in cdl)
+        self.assertTrue('note = "a", "b\\"c", "d", "e" ;' in cdl)
+        self.assertTrue('char note(point, note_strlen);' in cdl)
+        t=BADCtf('r',self.sample)
+        cdl=t._cdl()
+        self.assertTrue('13 = "EU6349", "EU6349", "CNJCA314"' in cdl)
+        t=BADCtf()
+        t.add_metadata('type','int','x')
+        t.add_variable('x',range(25))
+        data=t._cdl().split('data:')[1]
+        self.assertEqual(data.count(',\n    '),2)
+        self.assertTrue('20, 21, 22, 23, 24 ;' in data)
+
+    def testNAData(self):
+        ''' NASA Ames data is written a row per line '''
+        na=self.t._NASA_Ames()
+        self.assertTrue(na.endswith('\n18 305.6 1005.7\n24 305.2 1015.2\n'))
+        self.assertEqual(na.split('\n',1)[0].split(),['%s' % (na.count('\n')-4),'1001'])
+
+    def testTypedStorage(self):
+        ''' columns read from file are held in typed buffers '''
+        self.t.write(self.dummycsv)
+        t2=BADCtf('r',self.dummycsv)
+        self.assertEqual(t2[0],[6,12,18,24])
+        self.assertEqual(t2[1],[301.2,303.4,305.6,305.2])
+        self.assertEqual(t2._data.variables[0].buffers().typecode,'l')
+        self.assertEqual(t2._data.variables[1].buffers().typecode,'d')
+
+    def testCharStorage(self):
+        ''' char columns use offsets into one byte buffer '''
+        v=BADCtfVariable(('ab','','cde'),'char')
+        offsets,chars=v.buffers()
+        self.assertEqual(list(offsets),[0,2,2,5])
+        self.assertEqual(bytes(chars),'abcde')
+        self.assertEqual(v[-1],'cde')
+        self.assertEqual(v.values,['ab','','cde'])
+
+    def testTypedFallback(self):
+        ''' values that do not fit the type fall back to char storage '''
+        v=BADCtfVariable(('1','2'),'int')
+        v.append('x')
+        self.assertEqual(v.vtype,'char')
+        self.assertEqual(v.values,['1','2','x'])
+
+    def testUntypedValues(self):
+        ''' columns built in memory without a type give their list '''
+        self.assertEqual(self.t[0],[6,12,18,24])
+        self.assertEqual(self.t[2][:2],[1002.2,1004.4])
        
 
 if __name__ == "__main__":
@@ -0,0 +1,287 @@
+#
+# Benchmarks for reading, checking and writing badc text files.
+#
+# Synthetic files of any size are made from the metadata of makeBasicDummy
+# and the column labels in BADCtf.MDinfo. Each phase is timed in its own
+# worker process, so the peak memory (maxrss) of the phase is its own, and
+# the results can be saved as a JSON baseline to compare later runs with.
+#
+# python BADCtfBench.py --rows 100000 --columns 35 --baseline bench.json
+#
+# Running the module runs the benchmark, so its tests are run with
+#
+# python -m unittest BADCtfBench
+#
+
+from BADCtf import BADCtf,BADCtfMetadata,checkString,checkFloat,\
+     makeBasicDummy,_scan_records
+
+import unittest, os, sys, time, json, itertools, optparse
+import multiprocessing, resource, shutil, tempfile
+
+# the phases that can be timed, in order
+PHASES = ['parse', 'check_valid', 'check_complete', 'csv', 'cdl', 'na',
+          'btf2nc']
+
+# column types for the synthetic columns after the time column
+TYPES = ['float', 'int', 'char']
+
+# relative slowdown (or memory growth) allowed by compare
+TOLERANCE = 0.25
+
+def _extra_labels():
+    # column labels in MDinfo with values we can make up, for the extra
+    # metadata records
+    labels = []
+    for label in sorted(BADCtf.MDinfo):
+        applyg, applyc, mino, maxo, mandb, mandc, check, meaning = \
+            BADCtf.MDinfo[label]
+        if applyc and check in (checkString, checkFloat) and \
+           label not in ('long_name', 'type'):
+            labels.append((label, mino, check))
+    return labels
+
+def makeSynthetic(filename, rows=1000, columns=10, density=1, records=1):
+    ''' Write a valid badc text file to filename with records data
+        records, each of rows rows and columns columns. The first column
+        is a time coordinate variable; the others are float, int and char
+        in turn. The global metadata is that of makeBasicDummy, and each
+        column has density extra records with labels taken from
+        BADCtf.MDinfo. '''
+    basic = makeBasicDummy()
+    labels = _extra_labels()
+    f = open(filename, 'w')
+    try:
+        for k in range(records):
+            tf = BADCtf()
+            for label, values in basic._metadata.globalRecords:
+                if label != 'Conventions':
+                    tf.add_metadata(label, values)
+            names = ['time'] + ['v%d' % j for j in range(1, columns)]
+            vtypes = ['int'] + [TYPES[(j-1) % 3] for j in range(1, columns)]
+            for j, (name, vtype) in enumerate(zip(names, vtypes)):
+                tf.add_metadata('long_name', ('Column %d' % j, '1'), name)
+                tf.add_metadata('type', vtype, name)
+                if j == 0:
+                    tf.add_metadata('coordinate_variable', '1', name)
+                for n in range(density):
+                    label, mino, check = labels[(j+n) % len(labels)]
+                    if check is checkFloat: value = str(n+1.0)
+                    else: value = 'value %d' % n
+                    tf.add_metadata(label, (value,)*mino, name)
+                tf.add_variable(name)
+            writer = tf.open_writer(f)
+            for start in range(0, rows, 10000):
+                block = range(start, min(start+10000, rows))
+                cells = [block]
+                for j, vtype in enumerate(vtypes[1:]):
+                    if vtype == 'float':
+                        cells.append([i*0.5+j for i in block])
+                    elif vtype == 'int':
+                        cells.append([i % 1000 + j for i in block])
+                    else:
+                        cells.append(['s%d' % (i % 100) for i in block])
+                writer.append_rows(itertools.izip(*cells))
+            writer.close()
+    finally:
+        f.close()
+
+def _maxrss():
+    # peak resident memory of this process in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _read(filename):
+    # read every record of filename without timing it
+    return [BADCtf('r', filename, offset=start)
+            for start, data, end in _scan_records(filename)]
+
+def _run_phase(job):
+    # time one phase in a worker process, returning (seconds, maxrss,
+    # growth), where growth is the rise of maxrss during the phase
+    phase, filename, outdir = job
+    if phase == 'parse':
+        starts = [start for start, data, end in _scan_records(filename)]
+    elif phase in ('check_valid', 'check_complete'):
+        tfs = _read(filename)
+    else:
+        tfs = _read(filename)
+        out = os.path.join(outdir, 'bench_%s_%%d' % phase)
+    if phase == 'btf2nc':
+        from BADCtfTools import btf2nc
+
+    before = _maxrss()
+    t = time.time()
+    if phase == 'parse':
+        for start in starts:
+            tf = BADCtf()
+            tf._metadata = BADCtfMetadata()
+            tf.mode = 'r'
+            tf._parse(filename, offset=start)
+    elif phase == 'check_valid':
+        for tf in tfs: tf._check_valid()
+    elif phase == 'check_complete':
+        for tf in tfs: tf._check_complete('complete')
+    elif phase == 'btf2nc':
+        for k, tf in enumerate(tfs): btf2nc(out % k, badctf=tf).close()
+    else:
+        for k, tf in enumerate(tfs): tf.write(out % k, phase)
+    seconds = time.time() - t
+    after = _maxrss()
+    return seconds, after, after - before
+
+def run(filename, phases=PHASES):
+    ''' Time each of phases on filename, each in a fresh worker process.
+        Returns a dictionary keyed by phase of dictionaries with the
+        seconds taken, the peak memory (maxrss, in kilobytes) of the
+        worker, and how much the peak grew during the phase. Phases that
+        need a missing module (btf2nc needs pupynere) are left out. '''
+    results = {}
+    outdir = tempfile.mkdtemp()
+    try:
+        for phase in phases:
+            pool = multiprocessing.Pool(1)
+            try:
+                seconds, maxrss, growth = pool.apply(
+                    _run_phase, ((phase, filename, outdir),))
+                pool.close()
+            except ImportError:
+                continue
+            finally:
+                pool.terminate()
+                pool.join()
+            results[phase] = {'seconds': seconds, 'maxrss': maxrss,
+                              'growth': growth}
+    finally:
+        shutil.rmtree(outdir)
+    return results
+
+def benchmark(rows=1000, columns=10, density=1, records=1, phases=PHASES):
+    ''' Make a synthetic file of the given size, time phases on it and
+        return the results, with the size, as a dictionary '''
+    fd, filename = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        makeSynthetic(filename, rows, columns, density, records)
+        results = {'rows': rows, 'columns': columns, 'density': density,
+                   'records': records, 'bytes': os.path.getsize(filename),
+                   'phases': run(filename, phases)}
+    finally:
+        os.remove(filename)
+    return results
+
+def save_baseline(results, filename):
+    f = open(filename, 'w')
+    try:
+        json.dump(results, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+
+def load_baseline(filename):
+    f = open(filename)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    ''' Compare results with a baseline for the same size of file. Returns
+        a list of (phase, measure, baseline value, value) for each measure
+        that is more than tolerance (a fraction) worse than the baseline.
+        Memory growth smaller than a megabyte is not counted. '''
+    for key in ('rows', 'columns', 'density', 'records'):
+        if results[key] != baseline[key]:
+            raise ValueError('Baseline is for a different file: %s %s not %s'
+                             % (key, baseline[key], results[key]))
+    worse = []
+    for phase in sorted(results['phases']):
+        if phase not in baseline['phases']:
+            continue
+        new, old = results['phases'][phase], baseline['phases'][phase]
+        for measure in ('seconds', 'maxrss', 'growth'):
+            if measure == 'growth' and new[measure] < 1024:
+                continue
+            if new[measure] > old[measure] * (1 + tolerance):
+                worse.append((phase, measure, old[measure], new[measure]))
+    return worse
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--rows', type='int', default=100000)
+    parser.add_option('--columns', type='int', default=35)
+    parser.add_option('--density', type='int', default=1,
+                      help='extra metadata records per column')
+    parser.add_option('--records', type='int', default=1)
+    parser.add_option('--phases', default=','.join(PHASES))
+    parser.add_option('--baseline', help='JSON baseline to compare with')
+    parser.add_option('--save', action='store_true',
+                      help='save the results as the baseline')
+    parser.add_option('--tolerance', type='float', default=TOLERANCE)
+    options, args = parser.parse_args(argv)
+
+    results = benchmark(options.rows, options.columns, options.density,
+                        options.records, options.phases.split(','))
+    print '%(rows)s rows x %(columns)s columns x %(density)s x ' \
+          '%(records)s records, %(bytes)s bytes' % results
+    for phase in PHASES:
+        if phase in results['phases']:
+            print '%-15s %8.3fs %8dkB %8dkB' % ((phase,) + tuple(
+                results['phases'][phase][m]
+                for m in ('seconds', 'maxrss', 'growth')))
+    if options.baseline and options.save:
+        save_baseline(results, options.baseline)
+    elif options.baseline:
+        worse = compare(results, load_baseline(options.baseline),
+                        options.tolerance)
+        for phase, measure, old, new in worse:
+            print 'REGRESSION %s %s: %s -> %s' % (phase, measure, old, new)
+        return len(worse) > 0
+    return 0
+
+
+class test_bench(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dummyfile = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+
+    def tearDown(self):
+        if os.path.exists(self.dummyfile):
+            os.remove(self.dummyfile)
+
+    def test_synthetic(self):
+        makeSynthetic(self.dummyfile, rows=25, columns=5, density=3,
+                      records=2)
+        records = BADCtf.records(self.dummyfile)
+        self.assertEqual(len(records), 2)
+        for tf in records:
+            self.assertEqual(len(tf), 25)
+            self.assertEqual(tf.colnames(), ('time', 'v1', 'v2', 'v3', 'v4'))
+            self.assertEqual(tf[0][:3], [0, 1, 2])
+            self.assertEqual(tf[3][:2], ['s0', 's1'])
+            self.assertEqual(len(tf['*', 'v2']), 5)
+            tf._check_complete('complete')
+
+    def test_run(self):
+        makeSynthetic(self.dummyfile, rows=50, columns=4)
+        results = run(self.dummyfile, ['parse', 'csv'])
+        self.assertEqual(sorted(results), ['csv', 'parse'])
+        self.assertTrue(results['parse']['maxrss'] > 0)
+
+    def test_compare(self):
+        size = {'rows': 50, 'columns': 4, 'density': 1, 'records': 1}
+        results = dict(size, phases={
+            'csv': {'seconds': 2.0, 'maxrss': 50000, 'growth': 900},
+            'parse': {'seconds': 1.0, 'maxrss': 60000, 'growth': 9000}})
+        baseline = json.loads(json.dumps(results))
+        self.assertEqual(compare(results, baseline), [])
+        baseline['phases']['csv']['seconds'] = 1.0
+        baseline['phases']['csv']['growth'] = 100
+        baseline['phases']['parse']['growth'] = 2000
+        self.assertEqual(compare(results, baseline),
+                         [('csv', 'seconds', 1.0, 2.0),
+                          ('parse', 'growth', 2000, 9000)])
+        baseline['rows'] = 10
+        self.assertRaises(ValueError, compare, results, baseline)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,116 @@
-from pupynere import netcdf_file
+from pupynere import netcdf_file as _netcdf_file, netcdf_variable
+import numpy
 
-from BADCtf import BADCtf,makeBasicDummy
+from BADCtf import BADCtf,BADCtfDataError,ARRAY_TYPECODES,makeBasicDummy
 
-import unittest, uuid, os 
+import unittest, uuid, os, itertools
 
-def btf2nc(ncfilename,source_filename=None,badctf=None):
+# netCDF types for the BADC column types, with the numpy dtypes the data is
+# held in. char columns get a second dimension for the string length.
+NCTYPES = {'int': 'i', 'float': 'd', 'char': 'c'}
+NCDTYPES = {'int': '>i4', 'float': '>f8', 'char': '>c'}
+
+class netcdf_file(_netcdf_file):
+    ''' pupynere's netcdf_file, reading doubles as '>f8': pupynere asks
+        numpy for '>d8', which newer numpy releases don't understand '''
+    def _read_var(self):
+        var=list(_netcdf_file._read_var(self))
+        if var[6]=='>d8': var[6]='>f8'
+        return tuple(var)
+
+def btf2nc(ncfilename,source_filename=None,badctf=None,chunk=10000,
+           per_record=False):
     ''' Convert a badc text file object to a netcdf file object.
         Call by providing an output filename for the netcdf file,
-        and one of a source filename or a badctf instance '''
+        and one of a source filename or a badctf instance.
+        Columns are written chunk rows at a time as typed arrays; a
+        source file is streamed rather than read into a BADCtf.
+        With per_record each data record in the source file is written
+        to its own netcdf file, named by ncfilename % record number, and
+        the list of file names is returned. '''
     if source_filename is None and badctf is None:
         raise ValueError('Arguments must include on of a source file or BADCtf instance')
     elif source_filename is not None and badctf is not None:
         raise ValueError('Arguments must include only ONE of a source file or BADCtf instance')
         
-    if source_filename is not None:
-        tf=BADCtf('r',source_filename)
+    if per_record:
+        if source_filename is None:
+            raise ValueError('per_record needs a source file')
+        names=[]
+        records=BADCtf.records(source_filename)
+        for k in range(len(records)):
+            name=ncfilename % k
+            _stream2nc(name,source_filename,records.offsets[k][0],chunk).close()
+            names.append(name)
+        return names
+    elif source_filename is not None:
+        return _stream2nc(ncfilename,source_filename,0,chunk)
     else:
-        tf=badctf
-    
+        return _tf2nc(ncfilename,badctf,chunk)
+
+def _stream2nc(ncfilename,filename,offset,chunk):
+    # convert the record at offset in filename, reading it twice: once to
+    # count the rows and size the char columns, once for the values
+    stream=BADCtf.open_stream(filename,offset)
+    try:
+        vtypes=_vtypes(stream)
+        n=0
+        strlens=[1]*stream.nvar()
+        for columns in stream.columns(chunk):
+            n+=len(columns[0])
+            for j in range(stream.nvar()):
+                if vtypes[j]=='char':
+                    strlens[j]=max(strlens[j],max(map(len,columns[j])))
+    finally:
+        stream.close()
+    stream=BADCtf.open_stream(filename,offset)
+    try:
+        ncf,variables=_create(ncfilename,stream,n,strlens)
+        start=0
+        for arrays in stream.arrays(chunk):
+            for j,values in enumerate(arrays):
+                _put(variables[j],start,values,vtypes[j],strlens[j],stream.colnames()[j])
+            start+=len(arrays[0])
+    finally:
+        stream.close()
+    return ncf
+
+def _tf2nc(ncfilename,tf,chunk):
+    # convert a BADCtf instance, using its typed buffers without copying
+    vtypes=_vtypes(tf)
+    n=len(tf)
+    strlens=[1]*tf.nvar()
+    for j in range(tf.nvar()):
+        if vtypes[j]=='char':
+            for start in range(0,n,chunk):
+                values=tf._data.strings(j,start,start+chunk)
+                strlens[j]=max(strlens[j],max(map(len,values)))
+    ncf,variables=_create(ncfilename,tf,n,strlens)
+    for j in range(tf.nvar()):
+        variable=getattr(tf._data,'variables',None)
+        if variable and variable[j].vtype in ARRAY_TYPECODES:
+            buf=variable[j].buffers()
+            column=numpy.frombuffer(buf,ARRAY_TYPECODES[variable[j].vtype])
+        else:
+            column=None
+        for start in range(0,n,chunk):
+            if column is not None: values=column[start:start+chunk]
+            else: values=tf._data[j,start:start+chunk]
+            _put(variables[j],start,values,vtypes[j],strlens[j],tf.colnames()[j])
+    return ncf
+
+def _vtypes(tf):
+    # the declared type of each column
+    vtypes=[]
+    for v in tf.colnames():
+        vtype=tf._coltype(v)
+        if vtype not in NCTYPES:
+            raise BADCtfDataError('Column %s has no usable type (%s)'%(v,vtype))
+        vtypes.append(vtype)
+    return vtypes
+
+def _create(ncfilename,tf,n,strlens):
+    # make the netcdf file with its attributes, dimensions and variables
     ncf=netcdf_file(ncfilename,'w')
     
     # file global attributes
@@ -34,37 +127,122 @@ def btf2nc(ncfilename,source_filename=None,badctf=None):
     fvars={}
     # first get attributes into useful dictionary
     for v in tf.colnames():
-        attrs=tf._metadata[('*',v)]
         adict={}
         for a in tf._metadata[('*',v)]:
             adict[a[0]]=a[1]
         fvars[v]=adict
-    # now load up the coordinate variables first
-    index=-1
-    dimensions=[]
-    # we do this loop first for a future with multiple coordinate 
-    # variables
-    for v in tf.colnames():
-        index+=1
-        if 'coordinate_variable' in fvars[v]:
-            data=tf[index]
-            dlen=len(data)
-            dim=ncf.createDimension(v,dlen)
-            dimdata=ncf.createVariable(v,fvars[v]['type'][0],(v,))
-            dimdata[:]=data
-            dimensions.append(v)
     # now the assumption with a badc text file is that there is
     # only one coordinate variable.
     # not necessarily true for trajectory files, but one thing at a time ...
+    dimensions=[v for v in tf.colnames() if 'coordinate_variable' in fvars[v]]
     assert len(dimensions) == 1, "Code doesn't support multiple coordinate variables"
-    index=-1
-    for v in tf.colnames():
-        index+=1
-        if 'coordinate_variable' not in fvars[v]:
-            data=tf[index]
-            fdata=ncf.createVariable(v,fvars[v]['type'][0],tuple(dimensions))
-            fdata[:]=data
-    return ncf
+    ncf.createDimension(dimensions[0],n)
+    variables=[]
+    for j,v in enumerate(tf.colnames()):
+        vtype=fvars[v]['type'][0]
+        dims=tuple(dimensions)
+        if vtype=='char':
+            ncf.createDimension(v+'_strlen',strlens[j])
+            dims=dims+(v+'_strlen',)
+        # made here rather than by createVariable, which asks numpy for
+        # the '>d8' dtype for doubles (see netcdf_file)
+        shape=tuple([ncf.dimensions[d] for d in dims])
+        ncf.variables[v]=netcdf_variable(numpy.empty(shape,NCDTYPES[vtype]),
+                                         NCTYPES[vtype],shape,dims)
+        variables.append(ncf.variables[v])
+    return ncf,variables
+
+def _put(variable,start,values,vtype,strlen,colname):
+    # write one chunk of a column into a netcdf variable
+    try:
+        if vtype=='char':
+            values=numpy.asarray(values,'S%d'%strlen)
+            values=values.view('S1').reshape(len(values),strlen)
+        else:
+            values=numpy.asarray(values)
+            if vtype=='int':
+                # astype would wrap values too big for a netcdf int
+                values=values.astype('i8')
+                info=numpy.iinfo(variable.data.dtype)
+                if len(values) and (values.min()<info.min or values.max()>info.max):
+                    raise BADCtfDataError('Column %s has values outside the netcdf int range'%colname)
+            values=values.astype(variable.data.dtype)
+    except (ValueError,OverflowError):
+        raise BADCtfDataError('Column %s does not fit its type %s'%(colname,vtype))
+    variable[start:start+len(values)]=values
+
+    
+
+def nc2btf(ncfilename,target,chunk=10000):
+    ''' Convert a netcdf file to a badc text file, written to target (a
+        filename or writable file object). All variables must lie along
+        one dimension, with char variables having a second string length
+        dimension. Global attributes become global records, with values
+        joined by ';' (as btf2nc does) split into separate records.
+        Variable attributes become column records, with long_name and
+        units making the BADC long_name. Scalar variables (with no
+        dimensions, such as a grid mapping) have no column to go in and
+        are left out. The data is read from the memory mapped variables
+        and written chunk rows at a time. '''
+    ncf=netcdf_file(ncfilename,'r',mmap=True)
+    try:
+        tf=BADCtf()
+        for label,value in sorted(ncf._attributes.items()):
+            if label=='Conventions':
+                # the BADC Conventions record is already there
+                tf.add_metadata('comments','netCDF Conventions: %s'%value)
+            elif isinstance(value,basestring):
+                for v in value.split(';'):
+                    tf.add_metadata(label,v)
+            else:
+                tf.add_metadata(label,tuple([str(v) for v in numpy.ravel(value)]))
+
+        dims=set([v.dimensions[0] for v in ncf.variables.values() if v.dimensions])
+        if len(dims)!=1:
+            raise ValueError('Variables must all lie along one dimension, not %s'%sorted(dims))
+        dim=dims.pop()
+        # the coordinate variable first, then the rest by name
+        names=[v for v in ncf.variables if ncf.variables[v].dimensions]
+        names.sort(key=lambda v:(v!=dim,v))
+        variables=[ncf.variables[v] for v in names]
+        kinds=[]
+        for name,var in zip(names,variables):
+            kind=var.data.dtype.kind
+            if var.dimensions[0]!=dim or len(var.dimensions)!=(1+(kind=='S')):
+                raise ValueError('Cannot convert variable %s%s'%(name,var.dimensions))
+            kinds.append(kind)
+            attrs=dict(var._attributes)
+            tf.add_metadata('long_name',(attrs.pop('long_name',name),
+                                         attrs.pop('units','1')),name)
+            tf.add_metadata('type',{'i':'int','f':'float','S':'char'}[kind],name)
+            attrs.pop('type',None)
+            if name==dim:
+                tf.add_metadata('coordinate_variable','1',name)
+            for label,value in sorted(attrs.items()):
+                if not isinstance(value,basestring):
+                    value=tuple([str(v) for v in numpy.ravel(value)])
+                tf.add_metadata(label,value,name)
+            tf.add_variable(name)
+
+        n=ncf.dimensions[dim]
+        if n is None: n=ncf._recs
+        writer=tf.open_writer(target)
+        for start in range(0,n,chunk):
+            columns=[]
+            for var,kind in zip(variables,kinds):
+                values=var.data[start:start+chunk]
+                if kind=='S':
+                    values=values.view('S%d'%values.shape[1]).ravel().tolist()
+                elif values.dtype.itemsize==4 and kind=='f':
+                    # keep single precision values short
+                    values=map(str,values)
+                else:
+                    values=values.tolist()
+                columns.append(values)
+            writer.append_rows(itertools.izip(*columns))
+        writer.close()
+    finally:
+        ncf.close()
 
     
 
@@ -86,6 +264,76 @@ class test_btncf(unittest.TestCase):
         y=[n for n in n2.variables]
         self.assertEqual(x,y)
         
+    def test_readfile(self):
+        self.data.add_variable('note',('a','bc','def','g'))
+        self.data.add_metadata('type','char','note')
+        csvfile=self.dummyfile+'.csv'
+        try:
+            self.data.write(csvfile)
+            btf2nc(self.dummyfile,source_filename=csvfile,chunk=3).close()
+        finally:
+            os.remove(csvfile)
+        n2=netcdf_file(self.dummyfile)
+        self.assertEqual(list(n2.variables['time'][:]),[6,12,18,24])
+        self.assertEqual(n2.variables['temp'].typecode(),'d')
+        self.assertEqual(list(n2.variables['temp'][:]),[301.2,303.4,305.6,305.2])
+        self.assertEqual(n2.variables['note'][2].tostring(),'def')
+        n2.close()
+
+    def test_int_range(self):
+        self.data.add_variable('count',(1,2,3,2**31))
+        self.data.add_metadata('type','int','count')
+        self.assertRaises(BADCtfDataError,btf2nc,self.dummyfile,badctf=self.data)
+
+    def test_nc2btf(self):
+        ncf=netcdf_file(self.dummyfile,'w')
+        ncf.title='A test file'
+        ncf.creator='A Person;Another Person'
+        ncf.createDimension('time',3)
+        t=ncf.createVariable('time','i',('time',))
+        t[:]=[0,10,20]
+        t.units='minutes'
+        p=ncf.createVariable('temp','f',('time',))
+        p[:]=[280.5,281.25,282.0]
+        p.long_name='Temperature'
+        p.units='K'
+        ncf.createDimension('strlen',4)
+        c=ncf.createVariable('station','c',('time','strlen'))
+        c[:]=numpy.array(['ab','cdef','g']).astype('S4').view('S1').reshape(3,4)
+        crs=ncf.createVariable('crs','i',())
+        crs.grid_mapping_name='latitude_longitude'
+        ncf.close()
+        csvfile=self.dummyfile+'.csv'
+        try:
+            nc2btf(self.dummyfile,csvfile,chunk=2)
+            tf=BADCtf('r',csvfile)
+        finally:
+            os.remove(csvfile)
+        self.assertEqual(tf.colnames(),('time','station','temp'))
+        self.assertEqual(tf[0],[0,10,20])
+        self.assertEqual(tf[1],['ab','cdef','g'])
+        self.assertEqual(tf[2],[280.5,281.25,282.0])
+        self.assertEqual(tf['creator'],[('A Person',),('Another Person',)])
+        self.assertEqual(tf['long_name','temp'],[('Temperature','K')])
+        self.assertEqual(tf['coordinate_variable','time'],[('1',)])
+
+    def test_per_record(self):
+        csvfile=self.dummyfile+'.csv'
+        names=[]
+        try:
+            self.data.write(csvfile)
+            f=open(csvfile,'a')
+            f.write(open(csvfile).read())
+            f.close()
+            names=btf2nc(self.dummyfile+'%d',source_filename=csvfile,per_record=True)
+            self.assertEqual(len(names),2)
+            n2=netcdf_file(names[1])
+            self.assertEqual(list(n2.variables['press'][:]),[1002.2,1004.4,1005.7,1015.2])
+            n2.close()
+        finally:
+            for f in [csvfile]+names:
+                if os.path.exists(f): os.remove(f)
+        
 if __name__=="__main__":
     unittest.main()
         